@@ -0,0 +1,210 @@
+""" Benchmark of the stages of multiplanetaryListUpdBot on synthetic catalogs
+
+Generates exoplanet.eu and NASA csv files and a Wikipedia raw page with the requested number of planets,
+serves them from a local HTTP stand-in, answers Simbad queries from the synthetic catalog and times every stage
+(wall time, then peak of Python memory in a second pass on a new database). Results are saved as JSON to compare versions.
+
+    python benchmark.py --sizes 1000 10000 100000 1000000 --out benchmark.json
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sqlite3 as sl
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+from astropy.table import Table, MaskedColumn
+
+import multiplanetaryListUpdBot as bot
+
+unknownToSimbad = 0.05  # fraction of stars not found by query_objects, found by the online fallback
+
+def syntheticSystems(planets, seed=1):
+    """Return a list of synthetic systems (name, raDeg, decDeg, dist in pc, V mag, planets) with planets planets in total"""
+
+    rnd = random.Random(seed)
+    systems = []
+    total = 0
+    while total < planets:
+        n = min(rnd.choice([1, 1, 2, 2, 3, 4, 5]), planets - total)
+        systems.append(("SYN-%07d" % len(systems), rnd.uniform(0, 360), rnd.uniform(-89, 89),
+                        round(rnd.uniform(1, 3000), 2), round(rnd.uniform(2, 16), 2), n))
+        total += n
+    return systems
+
+def writeExoplanetCsv(systems, path):
+    """Write the systems as an exoplanet.eu catalog, one line per planet"""
+
+    header = ["name", "planet_status", "mass"] + bot.exoplanetColumns[2:]
+    with open(path, "w", encoding="utf-8", newline="") as csvFile:
+        csvFile.write(",".join(header) + "\n")
+        for name, ra, dec, dist, mag, n in systems:
+            for p in range(n):
+                values = {"name": name + " " + "bcdefghij"[p], "planet_status": "Confirmed", "mass": "1.5",
+                          "star_name": name, "ra": repr(ra), "dec": repr(dec), "mag_v": str(mag), "star_distance": str(dist),
+                          "star_metallicity": "0.01", "star_mass": "1.02", "star_radius": "0.98", "star_sp_type": "G2 V",
+                          "star_age": "4.6", "star_teff": "5778", "star_alternate_names": "\"HD " + name[4:] + ", HIP " + name[4:] + "\""}
+                csvFile.write(",".join(values[column] for column in header) + "\n")
+
+def writeNasaCsv(systems, path):
+    """Write the systems as the pscomppars table of the NASA archive: half by name, half with another name"""
+
+    with open(path, "w", encoding="utf-8", newline="") as csvFile:
+        csvFile.write("hostname,ra,dec,sy_vmag,sy_dist,st_spectype,st_mass,st_rad,st_teff,st_age,st_met\n")
+        for i, (name, ra, dec, dist, mag, n) in enumerate(systems):
+            hostname = name if i % 2 == 0 else "NASA " + name[4:]
+            for p in range(n):
+                csvFile.write(f"\"{hostname}\",{ra},{dec},{mag},{dist},G2 V,1.02,0.98,5778,4.6,0.01\n")
+
+def writeWikipediaPage(systems, path):
+    """Write the raw page of it.wikipedia with one template row for every multiplanetary system"""
+
+    with open(path, "w", encoding="utf-8", newline="") as page:
+        page.write("<noinclude>{{Stelle con pianeti extrasolari confermati/Top}}</noinclude>\n")
+        for name, ra, dec, dist, mag, n in systems:
+            if n < 2:
+                continue
+            raH = ra / 15
+            decAbs = abs(dec)
+            raOut = "%02d|%02d|%05.2f" % (int(raH), int(raH * 60) % 60, (raH * 3600) % 60)
+            decOut = "%s%02d|%02d|%04.1f" % ("-" if dec < 0 else "", int(decAbs), int(decAbs * 60) % 60, (decAbs * 3600) % 60)
+            page.write("{{Stelle con pianeti extrasolari confermati\n")
+            page.write(("|Stella=[[" + name + "]]||Ascensione retta={{RA|" + raOut + "}}||Declinazione={{DEC|" + decOut +
+                        "}}||Magnitudine apparente=" + str(mag) + "||Distanza=" + str(round(dist * 3.261563777)) +
+                        "||Tipo spettrale=G2 V||Massa=1.02||Raggio=0.98||Temperatura=5778||Età=4.6||Metallicità=0.01||Pianeti=" +
+                        str(n) + "}}\n").replace(".", ","))
+        page.write("<noinclude>{{Stelle con pianeti extrasolari confermati/Bottom}}</noinclude>\n")
+
+class FakeSimbad:
+    """Stand-in of astroquery's SimbadClass answering from the synthetic catalog"""
+
+    catalog = {}  # name -> (raDeg, decDeg, dist in pc, V mag)
+
+    def add_votable_fields(self, *fields):
+        pass
+
+    def table(self, names, known):
+        rows = [self.catalog.get(name) if known(name) else None for name in names]
+        missing = [row is None for row in rows]
+        return Table({
+            "main_id": [name if row else "" for name, row in zip(names, rows)],
+            "ra": MaskedColumn([row[0] if row else 0.0 for row in rows], mask=missing),
+            "dec": MaskedColumn([row[1] if row else 0.0 for row in rows], mask=missing),
+            "mesdistance.dist": MaskedColumn([row[2] if row else 0.0 for row in rows], mask=missing),
+            "mesdistance.unit": MaskedColumn(["pc" if row else "" for row in rows], mask=missing),
+            "V": MaskedColumn([row[3] if row else 0.0 for row in rows], mask=missing),
+            "ids": ["HD " + name[4:] + "|HIP " + name[4:] + "|NASA " + name[4:] if row else "" for name, row in zip(names, rows)],
+            "user_specified_id": list(names)})
+
+    def query_objects(self, names):
+        return self.table(names, lambda name: zlib.crc32(name.encode()) % 1000 >= unknownToSimbad * 1000)  # same names on every run
+
+    def query_object(self, name):
+        result = self.table([name], lambda name: True)
+        return result if result["main_id"][0] else Table()
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def measureStage(function, args, memory):
+    """Run function(*args), return its wall time in seconds or, with memory, its peak of Python memory in bytes
+    (traced by tracemalloc, which slows it down: never both in the same run)"""
+
+    if memory:
+        tracemalloc.start()
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def runStages(dataDir, memory):
+    """Run every stage on a new database in dataDir, return {stage: measureStage}"""
+
+    dbFile = os.path.join(dataDir, "stars-memory.db" if memory else "stars.db")
+    for path in (dbFile, dbFile + "-wal", dbFile + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    bot.sqliteConn = sl.connect(dbFile)
+    bot.sqliteCursor = bot.sqliteConn.cursor()
+    bot.configureBuildDB()
+    bot.createTables()
+
+    results = {}
+    for stage, function, args in [("getDataFromExoplanet", bot.getDataFromExoplanet, (None,)),
+                                  ("getDataFromSimbadSite", bot.getDataFromSimbadSite, ()),
+                                  ("getDataFromNASA", bot.getDataFromNASA, (None,)),
+                                  ("getDataFromWikipedia", bot.getDataFromWikipedia, (None,)),
+                                  ("generateWikitable", bot.generateWikitable, (os.path.join(dataDir, "tabella.wiki"),))]:
+        results[stage] = measureStage(function, args, memory)
+    bot.sqliteConn.close()
+    return results
+
+def benchmarkSize(planets, workDir):
+    """Run every stage on a synthetic catalog with planets planets, return {stage: {seconds, peakBytes}}"""
+
+    dataDir = os.path.join(workDir, str(planets))
+    os.makedirs(dataDir, exist_ok=True)
+    systems = syntheticSystems(planets)
+    writeExoplanetCsv(systems, os.path.join(dataDir, "exoplanet.csv"))
+    writeNasaCsv(systems, os.path.join(dataDir, "nasa.csv"))
+    writeWikipediaPage(systems, os.path.join(dataDir, "wikipedia.txt"))
+    FakeSimbad.catalog = {name: (ra, dec, dist, mag) for name, ra, dec, dist, mag, n in systems}
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=dataDir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    baseUrl = "http://127.0.0.1:%d/" % server.server_address[1]
+    bot.sources = {"exoplanet": {"url": baseUrl + "exoplanet.csv"},
+                   "nasa": {"url": baseUrl + "nasa.csv"},
+                   "wikipedia": {"url": baseUrl + "wikipedia.txt"}}
+    bot.snapshotDir = os.path.join(dataDir, "snapshots")
+
+    try:
+        seconds = runStages(dataDir, memory=False)
+        peaks = runStages(dataDir, memory=True)
+    finally:
+        server.shutdown()
+    results = {}
+    for stage in seconds:
+        results[stage] = {"seconds": round(seconds[stage], 3), "peakBytes": peaks[stage]}
+        print(f"{planets:>8} planets  {stage:<22} {seconds[stage]:9.2f} s  {peaks[stage] / 2**20:9.1f} MB")
+    return results
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark of multiplanetaryListUpdBot on synthetic catalogs")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="number of planets of the catalogs (e.g. 1000 10000 100000 1000000)")
+    parser.add_argument("--out", default="benchmark.json", help="JSON file for the results")
+    parser.add_argument("--workdir", default=None, help="directory for the generated data (default: a temporary one)")
+    args = parser.parse_args()
+
+    bot.SimbadClass = FakeSimbad
+    bot.simbadRequestsPerSecond = 0  # no rate limit against the stand-in
+    bot.simbadLocal.__dict__.clear()
+    workDir = args.workdir or tempfile.mkdtemp(prefix="multiplanetaryBench")
+
+    try:
+        version = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        version = ""
+    report = {"version": version, "time": time.strftime("%Y-%m-%d %H:%M:%S"), "results": {}}
+    for planets in args.sizes:
+        report["results"][str(planets)] = benchmarkSize(planets, workDir)
+
+    with open(args.out, "w", encoding="utf-8") as out:
+        json.dump(report, out, indent=2)
+    print("Results saved in", args.out)
+
+if __name__ == "__main__":
+    main()
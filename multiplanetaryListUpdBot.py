@@ -1,17 +1,120 @@
 import re
+import csv
+import math
+import os
+import json
+import shutil
+import numpy as np
 import sqlite3 as sl
-from astroquery.simbad import Simbad
 import warnings
-from astroquery.exceptions import AstropyWarning
 import logging
-import requests
-#import codecs
-#import time
+import argparse
+import time
+import threading
+import functools
+import io
+import hashlib
+import gzip
+import pickle
+import bisect
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 #from datetime import datetime
-
-sqliteConn = sl.connect('stars.db')
-sqliteCursor = sqliteConn.cursor()
+# astroquery and requests are slow to import: they're imported by configuredSimbad and httpSession when first needed
+
+dbPath = "stars.db"
+sqliteConn = None  # opened by connectDB
+sqliteCursor = None
+publishPath = None  # with a build in memory (see openBuildDB): path where publishDB copies it
+SimbadClass = None  # astroquery.simbad.SimbadClass, imported by configuredSimbad
+tableOutFile = "tabella.wiki"
+historyRuns = 50  # runs kept in the run history of stars.db (see recordRun), the older ones are deleted
+historyFields = ["name", "ra", "dec", "mag", "dist", "type", "mass", "radius", "temp", "age", "metall", "planets"]  # columns of 'stars' compared by diffRuns
+columnarDir = None  # directory of the columnar snapshot of 'stars' and 'simbad' written after render (see exportColumnar), None for none
 brownDwarfMassLimit = 13.0
+simbadCacheTTL = 30*24*3600  # seconds after which a cached Simbad answer is queried again
+simbadMaxWorkers = 8  # concurrent online Simbad queries
+simbadRequestsPerSecond = 5.0  # max rate of online Simbad queries of all the workers
+simbadRetries = 3  # attempts for a failing online Simbad query
+simbadBackoff = 2.0  # seconds to wait after the first failed attempt, doubled on every retry
+simbadBatchSize = 500  # names sent in one Simbad.query_objects call, 0 for a single call with all the names
+watchIntervals = {"exoplanet": 6*3600, "nasa": 24*3600, "wikipedia": 3600}  # seconds between two polls of every source by watch
+simbadBatchWorkers = 4  # query_objects calls running at the same time
+simbadResolver = "query_objects"  # "tap": resolve all the names with one query to simbadTapUrl (see query_objects_tap)
+simbadTapUrl = "https://simbad.cds.unistra.fr/simbad/sim-tap/sync"
+simbadTapQuery = """SELECT t.name, b.main_id, b.ra, b.dec, f.V, d.dist, d.unit, i.ids
+FROM TAP_UPLOAD.names AS t
+JOIN ident AS n ON n.id = t.name
+JOIN basic AS b ON b.oid = n.oidref
+LEFT JOIN ids AS i ON i.oidref = b.oid
+LEFT JOIN allfluxes AS f ON f.oidref = b.oid
+LEFT JOIN mesDistance AS d ON d.oidref = b.oid"""
+simbadLocal = threading.local()
+crossMatchTolerance = 30.0  # arcsec: max distance between the coordinates of the same star from different sources
+simbadMatchTolerance = 1.0  # arcsec: max distance between coordinates of the same object given by Simbad
+simbadNotFound = (None, None, 0, 0, None, None, None)  # answer (ra, dec, dist, mag, ids, raDeg, decDeg) for a star not found
+writeBatchSize = 1000  # rows written together by WriteBuffer with executemany
+parseWorkers = 1  # processes parsing the exoplanet.eu catalog, each on a byte range of the file starting with a new host star
+parseChunkBytes = 1 << 20  # min size of a byte range: smaller catalogs are parsed by one process
+buildPragmas = [  # stars.db keeps simbad_cache, the checkpoints and the history between runs: fast, but never corrupted
+        "PRAGMA journal_mode=WAL",  # unlike MEMORY, a killed run leaves a valid db to resume from its checkpoints
+        "PRAGMA synchronous=NORMAL",  # with WAL an OS crash loses at most the last commits, OFF could corrupt the file
+        "PRAGMA cache_size=-65536"  # 64 MB
+]
+
+snapshotDir = "snapshots"  # local copies of the downloaded sources, used for conditional requests and offline runs
+offlineMode = False  # True: never download, use the last snapshot of every source
+httpTimeout = 60  # seconds
+httpPoolSize = 8  # connections kept open by the shared session for every host
+sources = {  # sources downloaded by fetchSource
+        "exoplanet": {
+            "url": "http://exoplanet.eu/catalog/csv/"
+        },
+        "nasa": {
+            "url": "https://exoplanetarchive.ipac.caltech.edu/TAP/sync",
+            "params": {
+                "query": "select hostname,ra,dec,sy_vmag,sy_dist,st_spectype,st_mass,st_rad,st_teff,st_age,st_met from pscomppars",
+                "format": "csv"
+            }
+        },
+        "wikipedia": {
+            "url": "https://it.wikipedia.org/w/index.php",
+            "params": {
+                "action": "raw",
+                "title": "Sistemi_multiplanetari"
+            },
+            "headers": {
+                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+                              "AppleWebKit/537.36 (KHTML, like Gecko) "
+                              "Chrome/58.0.3029.110 Safari/537.3",
+                "Accept": "text/plain; charset=utf-8"
+            }
+        }
+}
+httpSessionShared = None
+cassetteMode = None  # "record": save every Simbad answer and download in cassetteDir, "replay": take them from there, without network
+cassetteDir = "cassettes"
+nameResolverShared = None
+
+resumePipeline = False  # True: skip the stages completed by the previous run (see pipeline_checkpoints in stars.db)
+
+collectMetrics = False  # True: record timings and counters of the run in metricsJsonFile and metricsPromFile
+metricsJsonFile = "metrics.json"
+metricsPromFile = "multiplanetaryListUpdBot.prom"  # for the textfile collector of the Prometheus node exporter
+instrumentedFunctions = [  # functions timed by enableMetrics
+        "fetchSource", "getDataFromExoplanet", "getDataFromSimbadSite", "getDataFromNASA", "getDataFromWikipedia",
+        "generateWikitable", "query_simbad", "query_objects_batch", "query_objects_tap", "getCoordFromSimbadLocalTable", "nearestCoords"
+]
+metricsEnabled = False
+metrics = {}  # "<name>.<field>" -> value
+metricsLock = threading.Lock()
+
+exoplanetColumns = [  # columns of the exoplanet.eu catalog used by getDataFromExoplanet, found by header name
+        "name", "mass", "star_name", "ra", "dec", "mag_v", "star_distance", "star_metallicity",
+        "star_mass", "star_radius", "star_sp_type", "star_age", "star_teff", "star_alternate_names"
+]
+nasaColumns = [  # columns of the NASA pscomppars table used by getDataFromNASA, found by header name
+        "hostname", "ra", "dec", "sy_vmag", "sy_dist", "st_spectype", "st_mass", "st_rad", "st_teff", "st_age", "st_met"
+]
 
 peculiar_star_names = {  #stars with peculiar names for Simbad, not easy to find
         "1RXS 1609": "1RXS J160929.1-210524",
@@ -40,22 +143,180 @@ def deg_to_hms(grad,cooType):
    
     return str(int(h))+"|"+str(int(m))+"|"+str(s)
 
+def deg_to_hms_array(grad,cooType):
+    """Vectorized deg_to_hms: convert an array (or astropy column) of degrees in a list of 'h|m|s' strings, identical to deg_to_hms.
+    Masked values are converted as 0"""
+
+    h = np.ma.filled(np.ma.asarray(grad, dtype=float), 0.0)
+    if(cooType == "RA"):
+        h = h/15
+
+    hInt = np.trunc(h)
+    m = np.abs((h-hInt)*60)
+    s = np.round((m-np.trunc(m))*60)  # half to even, like round()
+    carry = s == 60
+    s[carry] = 0
+    m[carry] += 1
+
+    hms = np.char.add(np.char.add(hInt.astype(np.int64).astype(str), "|"), np.trunc(m).astype(np.int64).astype(str))
+    return np.char.add(np.char.add(hms, "|"), s.astype(np.int64).astype(str)).tolist()
+
 def hms_to_numb(hms):
 
     hmsFields = hms.split("|")
     return int(hmsFields[0])*3600 + int(hmsFields[1])*60 + int(hmsFields[2])
 
-def zeroIfEmpty(val):
-    """Return 0 if val ='' """
-    if(val == ''):
-        return 0
-    return val
+def hms_to_deg(hms,cooType):
+    """Inverse of deg_to_hms for a 'h|m|s' string. The sign of hms is taken from its first field, also for '-0'"""
+
+    hmsFields = hms.split("|")
+    value = abs(float(hmsFields[0])) + float(hmsFields[1])/60 + float(hmsFields[2])/3600
+    if(hmsFields[0].strip().startswith("-")):
+        value = -value
+    if(cooType == "RA"):
+        value = value*15
+    return value
+
+def angularSeparation(ra1, dec1, ra2, dec2):
+    """Return the angle in arcsec between two points of coordinates in degrees"""
+
+    ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+    h = math.sin((dec2 - dec1)/2)**2 + math.cos(dec1)*math.cos(dec2)*math.sin((ra2 - ra1)/2)**2
+    return math.degrees(2*math.asin(min(1.0, math.sqrt(h))))*3600
+
+def nearestCoords(table, raDeg, decDeg, tolerance=None):
+    """Return (rowid, separation in arcsec) of the row of table ('stars' or 'simbad') nearest to raDeg, decDeg
+    and within tolerance arcsec (default crossMatchTolerance), using its R*Tree index '<table>_coords'. None if there isn't"""
+
+    if raDeg is None or decDeg is None:
+        return None
+    if tolerance is None:
+        tolerance = crossMatchTolerance
+
+    tolDeg = tolerance/3600
+    cosDec = math.cos(math.radians(min(abs(decDeg) + tolDeg, 90.0)))
+    raTol = tolDeg/cosDec if cosDec > tolDeg else 180.0  # near the poles every ra is possible
+    boxes = [(raDeg - raTol, raDeg + raTol)]
+    if boxes[0][0] < 0:  # ra wraps at 0/360
+        boxes.append((boxes[0][0] + 360, 360.0))
+    if boxes[0][1] > 360:
+        boxes.append((0.0, boxes[0][1] - 360))
+
+    best = None
+    for raMin, raMax in boxes:
+        sqliteCursor.execute(f"""SELECT t.rowid, t.raDeg, t.decDeg FROM {table}_coords c JOIN {table} t ON t.rowid = c.id
+                                 WHERE c.maxRa >= ? AND c.minRa <= ? AND c.maxDec >= ? AND c.minDec <= ?""",
+                             (raMin, raMax, decDeg - tolDeg, decDeg + tolDeg))
+        for rowid, ra, dec in sqliteCursor.fetchall():
+            separation = angularSeparation(raDeg, decDeg, ra, dec)
+            if separation <= tolerance and (best is None or separation < best[1]):
+                best = (rowid, separation)
+    return best
+
+class StarsIndex:
+    """Index in memory of the rows of 'stars' by coordinates, in cells of tolerance arcsec (default crossMatchTolerance),
+    and by name through nameResolver(). Built with one query, to match a whole catalog without a query per line"""
+
+    def __init__(self, tolerance=None):
+        self.tolerance = tolerance or crossMatchTolerance
+        self.cellDeg = self.tolerance/3600
+        self.raCells = math.ceil(360/self.cellDeg)
+        self.resolver = nameResolver()
+        self.byCell = {}
+        sqliteCursor.execute("SELECT rowid, raDeg, decDeg FROM stars WHERE raDeg IS NOT NULL AND decDeg IS NOT NULL")
+        for rowid, raDeg, decDeg in sqliteCursor.fetchall():
+            self.byCell.setdefault(self.cell(raDeg, decDeg), []).append((rowid, raDeg, decDeg))
+
+    def cell(self, raDeg, decDeg):
+        return math.floor(decDeg/self.cellDeg), math.floor(raDeg/self.cellDeg) % self.raCells
+
+    def match(self, name, raDeg, decDeg):
+        """Return (rowid, separation in arcsec) of the star named name (separation 0) or, if there isn't,
+        of the star nearest to raDeg, decDeg within tolerance. None if there isn't"""
+
+        rowid = self.resolver.resolve(name)
+        if rowid is not None:
+            return rowid, 0.0
+        if raDeg is None or decDeg is None:
+            return None
+
+        decCell, raCell = self.cell(raDeg, decDeg)
+        cosDec = math.cos(math.radians(min(abs(decDeg) + self.cellDeg, 90.0)))
+        raSpan = math.ceil(1/cosDec) if cosDec > self.cellDeg else self.raCells  # ra cells on every side
+        raCellsNear = range(self.raCells) if 2*raSpan + 1 >= self.raCells else [r % self.raCells for r in range(raCell - raSpan, raCell + raSpan + 1)]
+        best = None
+        for d in (decCell - 1, decCell, decCell + 1):
+            for r in raCellsNear:
+                for rowid, ra, dec in self.byCell.get((d, r), ()):
+                    separation = angularSeparation(raDeg, decDeg, ra, dec)
+                    if separation <= self.tolerance and (best is None or separation < best[1]):
+                        best = (rowid, separation)
+        return best
+
+def parseNumber(val):
+    """Return the number written in val, 0.0 if val is empty or not a number"""
+    try:
+        return float(val)
+    except ValueError:
+        return 0.0
+
+class StarSystem:
+    """A multiplanetary system, a row of 'stars'. Numeric fields are floats parsed once by the stage reading the source
+    (0.0 if unknown), ra and dec the strings 'h|m|s' and 'd|m|s' of the table, raDeg and decDeg in degrees"""
+
+    __slots__ = ("name", "ra", "dec", "mag", "dist", "type", "mass", "radius", "temp", "age", "metall", "planets", "altNames", "raDeg", "decDeg")
+    tableFields = __slots__[:12]  # fields written by renderTables
+
+    def __init__(self, name, ra=None, dec=None, mag=0.0, dist=0.0, type="", mass=0.0, radius=0.0, temp=0.0, age=0.0, metall=0.0,
+                 planets=0, altNames="", raDeg=None, decDeg=None):
+        self.name = name
+        self.ra = ra
+        self.dec = dec
+        self.mag = mag
+        self.dist = dist
+        self.type = type
+        self.mass = mass
+        self.radius = radius
+        self.temp = temp
+        self.age = age
+        self.metall = metall
+        self.planets = planets
+        self.altNames = altNames
+        self.raDeg = raDeg
+        self.decDeg = decDeg
+
+    def row(self):
+        """Return the values of the columns of 'stars' in the order of __slots__"""
+        return (self.name, self.ra, self.dec, self.mag, self.dist, self.type, self.mass, self.radius, self.temp, self.age, self.metall,
+                self.planets, self.altNames, self.raDeg, self.decDeg)
+
+    def asDict(self, fields=tableFields):
+        return {field: getattr(self, field) for field in fields}
+
+    def __eq__(self, other):
+        return isinstance(other, StarSystem) and self.row() == other.row()
+
+    def __repr__(self):
+        return "StarSystem" + repr(self.row())
+
+def selectStars(sql="", params=()):
+    """Yield a StarSystem for every row of 'stars' selected by sql (WHERE/ORDER BY clauses), read writeBatchSize rows at a time"""
+
+    sqliteCursor.execute("SELECT " + ",".join(StarSystem.__slots__) + " FROM stars " + sql, params)
+    while True:
+        rows = sqliteCursor.fetchmany(writeBatchSize)
+        if not rows:
+            return
+        for row in rows:
+            yield StarSystem(*row)
 
 def wikiRightFormat(val,precision):
     """Return '' if val = 0. if precision is specified (>= 0), apply it"""
 
     if(val == 0 or val == None):
         return ''
+    if isinstance(val, str):  # e.g. the spectral type, left as it is
+        return val
 
     try:
         float(val)
@@ -69,44 +330,336 @@ def wikiRightFormat(val,precision):
     else:
         return str(val)
 
+def countMetric(name, value=1):
+    """Add value to the metric name (nothing if the metrics are not enabled)"""
+
+    if metricsEnabled:
+        with metricsLock:
+            metrics[name] = metrics.get(name, 0) + value
+
+def timedFunction(name, function):
+    """Return function recording its calls and wall time in the metrics name.calls and name.seconds"""
+
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            countMetric(name + ".seconds", time.perf_counter() - start)
+            countMetric(name + ".calls")
+    return timed
+
+class TimedCursor:
+    """Proxy of a sqlite3 cursor recording calls, wall time and changed rows of every statement kind and table,
+    e.g. sql.UPDATE.stars.seconds"""
+
+    statementNames = {}
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def statementName(self, sql):
+        name = self.statementNames.get(sql)
+        if name is None:
+            words = sql.split()
+            table = re.search(r'\b(?:INTO|FROM|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)', sql, re.IGNORECASE)
+            name = "sql." + words[0].upper() + (("." + table.group(1)) if table else "")
+            self.statementNames[sql] = name
+        return name
+
+    def timed(self, function, sql, params):
+        name = self.statementName(sql)
+        start = time.perf_counter()
+        function(sql, *params)
+        countMetric(name + ".seconds", time.perf_counter() - start)
+        countMetric(name + ".calls")
+        if self.cursor.rowcount > 0:
+            countMetric(name + ".rows", self.cursor.rowcount)
+        return self
+
+    def execute(self, sql, *params):
+        return self.timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, *params):
+        return self.timed(self.cursor.executemany, sql, params)
+
+def enableMetrics():
+    """Start recording the metrics: wrap instrumentedFunctions and sqliteCursor. Without it nothing is measured or slowed down"""
+
+    global metricsEnabled, sqliteCursor
+    if metricsEnabled:
+        return
+    metricsEnabled = True
+    for name in instrumentedFunctions:
+        globals()[name] = timedFunction(name, globals()[name])
+    sqliteCursor = TimedCursor(sqliteCursor)
+
+def writeMetrics():
+    """Save the metrics of the run in metricsJsonFile and, in the Prometheus text format, in metricsPromFile"""
+
+    with metricsLock:
+        values = dict(sorted(metrics.items()))
+    with open(metricsJsonFile, "w", encoding="utf-8") as metricsFile:
+        json.dump({"time": time.time(), "metrics": values}, metricsFile, indent=2)
+
+    families = {}
+    for key, value in values.items():
+        name, field = key.rsplit(".", 1)
+        families.setdefault(field, []).append((name, value))
+    with open(metricsPromFile + ".part", "w", encoding="utf-8") as promFile:  # the collector must never read half a file
+        for field, samples in families.items():
+            promFile.write(f"# TYPE multiplanetary_{field} gauge\n")
+            for name, value in samples:
+                promFile.write(f'multiplanetary_{field}{{name="{name}"}} {value}\n')
+        promFile.write(f"# TYPE multiplanetary_last_run_timestamp_seconds gauge\nmultiplanetary_last_run_timestamp_seconds {time.time()}\n")
+    os.replace(metricsPromFile + ".part", metricsPromFile)
+
+class WriteBuffer:
+    """Collect the parameters of the statement sql and execute them with executemany every batchSize rows.
+    The caller commits once at the end of its stage, after flush()"""
+
+    def __init__(self, sql, batchSize=None):
+        self.sql = sql
+        self.batchSize = batchSize or writeBatchSize
+        self.rows = []
+
+    def add(self, params):
+        self.rows.append(params)
+        if len(self.rows) >= self.batchSize:
+            self.flush()
+
+    def extend(self, paramsList):
+        for params in paramsList:
+            self.add(params)
+
+    def flush(self):
+        if self.rows:
+            sqliteCursor.executemany(self.sql, self.rows)
+            self.rows = []
+
+def connectDB(path=None):
+    """Open the database path (default dbPath) as sqliteConn"""
+
+    global sqliteConn, sqliteCursor
+    sqliteConn = sl.connect(path or dbPath)
+    sqliteCursor = sqliteConn.cursor()
+
+persistentTables = ["simbad_cache", "pipeline_checkpoints", "runs", "run_stars"]  # kept between runs, always copied by openBuildDB
+
+def openBuildDB(path, seed=False, resume=False):
+    """Open sqliteConn as a database in memory, published to path by publishDB. With seed it starts as a copy of path
+    (incremental runs), otherwise only the persistentTables of path are copied. With resume it starts as a copy of the
+    partial build saved by saveResumeDB, if a previous run failed"""
+
+    global publishPath
+    connectDB(":memory:")
+    publishPath = path
+    if resume and os.path.exists(path + ".resume"):
+        path, seed = path + ".resume", True
+    if not os.path.exists(path):
+        return
+    if seed:
+        previous = sl.connect(path)
+        previous.backup(sqliteConn)
+        previous.close()
+        return
+    sqliteCursor.execute("ATTACH DATABASE ? AS previous", (path,))
+    for table in persistentTables:
+        sqliteCursor.execute("SELECT sql FROM previous.sqlite_master WHERE type='table' AND name=?", (table,))
+        schema = sqliteCursor.fetchone()
+        if schema:
+            sqliteCursor.execute(schema[0])
+            sqliteCursor.execute(f"INSERT INTO main.{table} SELECT * FROM previous.{table}")
+    sqliteConn.commit()
+    sqliteCursor.execute("DETACH DATABASE previous")
+
+def publishDB(path):
+    """Copy the database in memory in path with the backup API and a rename: readers of path see the previous build
+    or the new one, never a partial one"""
+
+    part = path + ".part"
+    if os.path.exists(part):
+        os.remove(part)
+    target = sl.connect(part)
+    sqliteConn.backup(target)
+    target.close()
+    if os.path.exists(path):
+        previous = sl.connect(path, timeout=60)  # waits for the readers of a file in WAL mode
+        try:  # a stars.db-wal left next to the new file would be applied to it
+            previous.execute("PRAGMA journal_mode=DELETE")
+        except sl.OperationalError as err:
+            print("Database "+path+" in use, the new build is in "+part+":", err)
+            logging.error(f"publishDB: {path} in use, the new build is in {part}: {err}")
+            exit()
+        finally:
+            previous.close()
+    os.replace(part, path)
+    if os.path.exists(path + ".resume"):  # the build failed before is complete now
+        os.remove(path + ".resume")
+    logging.info(f"publishDB: build published in {path}")
+
+def saveResumeDB(path):
+    """Copy the partial build in memory of a failed run in path.resume, where openBuildDB restarts from with resume:
+    path keeps the previous complete build"""
+
+    sqliteConn.rollback()  # the failed stage runs again
+    resumeFile = path + ".resume"
+    if os.path.exists(resumeFile):
+        os.remove(resumeFile)
+    target = sl.connect(resumeFile)
+    sqliteConn.backup(target)
+    target.close()
+    print("Partial build saved in "+resumeFile+": run again with --memory --resume to restart from it")
+    logging.info(f"saveResumeDB: partial build saved in {resumeFile}")
+
+def configureBuildDB():
+    """Apply buildPragmas to stars.db"""
+
+    for pragma in buildPragmas:
+        sqliteCursor.execute(pragma)
+
+spacesRe = re.compile(r'\s+')
+simbadPrefixRe = re.compile(r'^(?:name|\*{1,2}) ')
+
+def normalizeId(identifier):
+    """Return the lookup key of a star name or Simbad identifier: lower case, single spaces,
+    without the Simbad prefixes 'NAME' and '*', Gliese as GJ"""
+
+    key = simbadPrefixRe.sub('', spacesRe.sub(' ', identifier).strip().lower())
+    if key.startswith("gliese "):  # Gliese stars appear as GJ in exoplanet.eu and Simbad
+        key = "gj " + key[7:]
+    return key
+
+def simbadIdRows(ra, dec, ids):
+    """Return the rows (id,ra,dec) of 'simbad_ids' for the 'simbad' row of coordinates ra, dec"""
+
+    keys = set(normalizeId(identifier) for identifier in ids.split("|") if identifier.strip())
+    return [(key, ra, dec) for key in keys]
+
+def indexSimbadIds(ra, dec, ids):
+    """Put every identifier of the 'simbad' row of coordinates ra, dec in the 'simbad_ids' alias table"""
+
+    sqliteCursor.executemany("INSERT OR IGNORE INTO simbad_ids (id,ra,dec) VALUES(?,?,?);", simbadIdRows(ra, dec, ids))
+
 def getCoordFromSimbadLocalTable(star):
 
     logging.debug(f"getCoordFromSimbad: {star}")
 
-    sqliteCursor.execute("SELECT ra, dec, dist, mag, ids FROM simbad WHERE REPLACE(ids, '  ', ' ') LIKE '%' || REPLACE(?, '  ', ' ') || '%'", (star,))
+    sqliteCursor.execute("""
+        SELECT s.ra, s.dec, s.dist, s.mag, s.ids, s.raDeg, s.decDeg
+        FROM simbad_ids i JOIN simbad s ON s.ra = i.ra AND s.dec = i.dec
+        WHERE i.id = ?""", (normalizeId(star),))
     rows = sqliteCursor.fetchall()
    
     if(len(rows) == 0):
-        return None, None, 0, 0, None
+        return simbadNotFound
     if(len(rows) == 1):
-        return rows[0][0], rows[0][1], rows[0][2], rows[0][3], rows[0][4]
+        return rows[0]
 
-    # In case of multiple records
+    # In case of multiple records, keep the ones still listing star among their ids, compared as in 'simbad_ids'
     count = 0
-    pattern = re.escape(star) + r'\||' + re.escape(star) + r'$'
+    key = normalizeId(star)
     for row in rows:
-        ids = re.sub(r'\s+', ' ', row[4])  # Remove multiple spaces
-        if re.search(pattern, ids, re.IGNORECASE):
+        if any(normalizeId(identifier) == key for identifier in row[4].split("|")):
             rec = row
             count += 1
 
     if count != 1:
         logging.warning(f"getCoordFromSimbadLocalTable: found {count} data record for {star}.")
-        return None, None, 0, 0, None
+        return simbadNotFound
     else:
-        return rec[0], rec[1], rec[2], rec[3], rec[4]
+        return rec
+
+def cassettePath(key):
+    return os.path.join(cassetteDir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".gz")
 
-def query_simbad(name):
-    result = Simbad.query_object(name)
+def putCassette(key, answer):
+    """Save answer (any picklable object) to the request key in cassetteDir, one gzip file per key"""
+
+    os.makedirs(cassetteDir, exist_ok=True)
+    path = cassettePath(key)
+    part = path + "." + str(threading.get_ident()) + ".part"  # recorded by several threads
+    with gzip.open(part, "wb") as cassette:
+        pickle.dump((key, answer), cassette, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(part, path)
+
+def getCassette(key):
+    """Return the answer recorded for the request key. Raise LookupError if it was never recorded.
+    Cassettes are pickles: replay only the ones recorded by this program"""
+
+    try:
+        with gzip.open(cassettePath(key), "rb") as cassette:
+            recordedKey, answer = pickle.load(cassette)
+    except FileNotFoundError:
+        recordedKey = None
+    if recordedKey != key:
+        raise LookupError(f"No answer to {key!r} recorded in {cassetteDir}")
+    return answer
+
+class CassetteSimbad:
+    """Stand-in of astroquery's SimbadClass for cassetteMode: with simbad (a real SimbadClass) records its answers,
+    without answers from the cassettes"""
+
+    def __init__(self, simbad=None):
+        self.simbad = simbad
+        self.fields = []
+
+    def add_votable_fields(self, *fields):
+        self.fields.extend(fields)
+        if self.simbad is not None:
+            self.simbad.add_votable_fields(*fields)
+
+    def answer(self, method, argument):
+        key = "simbad " + method + " " + json.dumps([self.fields, argument])
+        if self.simbad is None:
+            return getCassette(key)
+        result = getattr(self.simbad, method)(argument)
+        putCassette(key, result)
+        return result
+
+    def query_objects(self, names):
+        return self.answer("query_objects", list(names))
+
+    def query_object(self, name):
+        return self.answer("query_object", name)
+
+def configuredSimbad():
+    """Return the Simbad instance of the current thread, with the votable fields used by the program added only once"""
+
+    global SimbadClass
+    simbad = getattr(simbadLocal, "simbad", None)
+    if simbad is None:
+        if cassetteMode == "replay":  # astroquery not even imported
+            simbad = CassetteSimbad()
+        else:
+            if SimbadClass is None:
+                from astroquery.simbad import SimbadClass
+                from astroquery.exceptions import AstropyWarning
+                warnings.filterwarnings('ignore', category=AstropyWarning)
+            simbad = SimbadClass()
+            if cassetteMode == "record":
+                simbad = CassetteSimbad(simbad)
+        simbad.add_votable_fields('mesdistance','V','ids')
+        simbadLocal.simbad = simbad
+    return simbad
+
+def query_simbad(name, simbad=None):
+    if simbad is None:
+        simbad = configuredSimbad()
+    result = simbad.query_object(name)
     if result: # if found use only the first result [0]
         ra = deg_to_hms(result['ra'][0], "RA")
         dec = deg_to_hms(result['dec'][0], "DEC")
         distance = pc2LigthYear(result['mesdistance.dist'][0], result['mesdistance.unit'][0])
-        mag = result['V'][0]
+        mag = 0.0 if np.ma.is_masked(result['V'][0]) else float(result['V'][0])  # a masked value would be saved as a BLOB
         ids = re.sub(r'\|\*\s{1,2}', '|', result['ids'][0])  #drop leading asterisks and spaces
         ids = re.sub(r'NAME\s+', '', ids)  # Remove "NAME " from the name
-        return ra, dec, distance, mag, ids
-    return None, None, 0, 0, None
+        return ra, dec, distance, mag, ids, float(result['ra'][0]), float(result['dec'][0])
+    return simbadNotFound
 
 def pc2LigthYear(distance, unit):
     distance = round(float(distance) * 3.261563777, 1)  # Convert parsecs to light-years
@@ -117,124 +670,511 @@ def pc2LigthYear(distance, unit):
 
     return distance
     
-def getCoordFromSimbadOnline(star):
+def round1_array(values):
+    """Round an array to 1 decimal with the same result of round(value, 1) on every element"""
+
+    scaled = values*10
+    rounded = np.rint(scaled)/10
+    nearTie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6  # x*10 may be inexact: let round() decide the ties
+    for i in np.flatnonzero(nearTie):
+        rounded[i] = round(float(values[i]), 1)
+    return rounded
+
+def pc2LigthYear_array(distance, unit):
+    """Vectorized pc2LigthYear: convert arrays (or astropy columns) of distances and units in a float array, identical to pc2LigthYear.
+    Masked distances are converted as nan"""
+
+    distance = round1_array(np.ma.filled(np.ma.asarray(distance, dtype=float), np.nan) * 3.261563777)  # Convert parsecs to light-years
+    unit = np.ma.filled(np.ma.asarray(unit, dtype=str), "")
+    kpc = np.char.find(unit, 'kpc') >= 0
+    Mpc = ~kpc & (np.char.find(unit, 'Mpc') >= 0)
+    distance[kpc] = distance[kpc]*1000
+    distance[Mpc] = distance[Mpc]*1000000
+
+    return distance
+
+def getSimbadCache(query, method="query_objects"):
+    """Return the row of 'simbad_cache' for the name query asked with method: (name,ra,dec,mag,dist,ids,raDeg,decDeg), name is None for names unknown to Simbad.
+    The answers of query_objects and query_object are kept apart: the second one finds names the first one misses.
+    Return None if query was never asked or its answer is older than simbadCacheTTL, always None in cassetteMode (every answer from Simbad)"""
+
+    if cassetteMode is not None:
+        return None
+    sqliteCursor.execute("""SELECT name,ra,dec,mag,dist,ids,raDeg,decDeg FROM simbad_cache
+                            WHERE query = ? AND method = ? AND fetched > ?""", (query, method, time.time() - simbadCacheTTL))
+    cached = sqliteCursor.fetchone()
+    countMetric("simbad_cache.misses" if cached is None else "simbad_cache.hits")
+    return cached
+
+def simbadCacheAnswer(cached):
+    """Return the 'simbad_cache' row cached as an answer of query_simbad"""
+
+    if cached[0] is None:
+        return simbadNotFound
+    return cached[1], cached[2], cached[4], cached[3], cached[5], cached[6], cached[7]
+
+def putSimbadCache(query, name, ra, dec, mag, dist, ids, raDeg, decDeg, method="query_objects"):
+    """Save the Simbad answer for the name query asked with method in 'simbad_cache'. name = None saves a negative result.
+    Nothing is saved in cassetteMode "replay": the answers of the cassettes are not reused by the real runs"""
+
+    if cassetteMode == "replay":
+        return
+    sqliteCursor.execute("INSERT OR REPLACE INTO simbad_cache (query,method,name,ra,dec,mag,dist,ids,raDeg,decDeg,fetched) VALUES(?,?,?,?,?,?,?,?,?,?,?);",
+            (query, method, name, ra, dec, mag, dist, ids, raDeg, decDeg, time.time()))
+
+def query_simbad_cached(name):
+    """Same as query_simbad, but use 'simbad_cache' if name was already asked in the last simbadCacheTTL seconds"""
+
+    cached = getSimbadCache(name, "query_object")
+    if cached:
+        return simbadCacheAnswer(cached)
+
+    ra, dec, distance, mag, ids, raDeg, decDeg = query_simbad(name)
+    putSimbadCache(name, name if ra else None, ra, dec, mag, distance, ids, raDeg, decDeg, "query_object")
+    return ra, dec, distance, mag, ids, raDeg, decDeg
+
+def nameVariants(star):
+    """Return star and the name it can have in the other catalogs, in order of preference"""
 
-    logging.debug(f"getCoordFromSimbadOnline: {star}")
-    
     name = star
     if star in peculiar_star_names:
         name = peculiar_star_names.get(star)
 
-    Simbad.add_votable_fields('mesdistance','V','ids')    
-
     if re.search(r"\s[A-D]$", star):
         name = re.sub(r"\s[A-D]$", "", star)  # Remove last letter for multiple systems, sometimes cataloged as single
 
     if re.search(r"\s\(AB\)$", star):
         name = re.sub(r"\s\(AB\)$", "", star)  # Remove characters indicating a double star, sometimes cataloged as single
 
-    response = query_simbad(star)
-    if response[0]:
-        return response
-    else:
-        response = query_simbad(name)
+    return list(dict.fromkeys([star, name]))
+
+def getCoordFromSimbadOnline(star):
+
+    logging.debug(f"getCoordFromSimbadOnline: {star}")
+    
+    for name in nameVariants(star):
+        response = query_simbad_cached(name)
         if response[0]:
             return response
-        else:
-            # If no results found
-            logging.debug(f"getCoordFromSimbadOnline: no results found for {star}")
-            return None, None, 0, 0, None
+
+    # If no results found
+    logging.debug(f"getCoordFromSimbadOnline: no results found for {star}")
+    return simbadNotFound
+
+class NameResolver:
+    """Map of the normalized names of the stars in 'stars' (see normalizeId) to their rowid, built once from the names,
+    peculiar_star_names, the exoplanet.eu alternate names, the Simbad ids of the star and nameVariants. A name given
+    to different stars by sources of the same rank is ambiguous and not resolved. The names are also kept sorted, to find them by prefix"""
+
+    def __init__(self):
+        self.keys = {}  # key -> (rank, rowid), rowid None if ambiguous
+        self.names = []  # sorted (key, rowid) of the names in 'stars'
+
+        sqliteCursor.execute("SELECT rowid, name, altNames FROM stars ORDER BY rowid")
+        stars = sqliteCursor.fetchall()
+        peculiarNames = {normalizeId(name): simbadName for name, simbadName in peculiar_star_names.items()}
+        for rowid, name, altNames in stars:
+            self.add(name, rowid, 0)
+            self.names.append((normalizeId(name), rowid))
+            if normalizeId(name) in peculiarNames:
+                self.add(peculiarNames[normalizeId(name)], rowid, 1)
+            for altName in (altNames or "").split(","):
+                self.add(altName, rowid, 2)
+            for variant in nameVariants(name)[1:]:
+                self.add(variant, rowid, 4)
+        # Simbad ids of the stars whose coordinates come from 'simbad'
+        sqliteCursor.execute("SELECT i.id, s.rowid FROM simbad_ids i JOIN stars s ON s.ra = i.ra AND s.dec = i.dec")
+        for key, rowid in sqliteCursor.fetchall():
+            self.add(key, rowid, 3)
+        self.names.sort()
+
+    def add(self, name, rowid, rank):
+        key = normalizeId(name)
+        if not key:
+            return
+        current = self.keys.get(key)
+        if current is None or rank < current[0]:
+            self.keys[key] = (rank, rowid)
+        elif rank == current[0] and current[1] != rowid:
+            self.keys[key] = (rank, None)
+
+    def resolve(self, name):
+        """Return the rowid of the star in 'stars' named name, None if unknown or ambiguous"""
+
+        found = self.keys.get(normalizeId(name))
+        return found[1] if found else None
+
+    def startsWith(self, prefix):
+        """Return the rowid of the first star in 'stars' whose name starts with prefix, None if there isn't"""
+
+        key = normalizeId(prefix)
+        if not key:
+            return None
+        first = None
+        for i in range(bisect.bisect_left(self.names, (key,)), len(self.names)):
+            name, rowid = self.names[i]
+            if not name.startswith(key):
+                break
+            first = rowid if first is None else min(first, rowid)
+        return first
+
+def nameResolver():
+    """Return the NameResolver shared by the stages, built on first use after 'stars' and 'simbad' are complete"""
+
+    global nameResolverShared
+    if nameResolverShared is None:
+        nameResolverShared = NameResolver()
+    return nameResolverShared
+
+class RateLimiter:
+    """Let at most rate calls of wait() per second pass, among all the threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def callSimbadWithRetry(limiter, function, *args):
+    """function(*args) respecting limiter, retried simbadRetries times with exponential backoff. Return None if every attempt failed.
+    An answer missing from the cassettes (LookupError) is raised at once: replaying it again would not find it"""
+
+    for attempt in range(simbadRetries):
+        limiter.wait()
+        try:
+            return function(*args)
+        except LookupError:
+            raise
+        except Exception as err:  # timeouts, connection and server errors
+            logging.warning(f"callSimbadWithRetry: attempt {attempt + 1} of {function.__name__} failed: {err}")
+            if attempt < simbadRetries - 1:
+                time.sleep(simbadBackoff * 2**attempt)
+    return None
+
+def resolveSimbadOnlineWorker(candidates, limiter):
+    """Thread body of resolveSimbadOnline: never touches the DB.
+    candidates is a list of (name, cached answer or None); return the list of (name, answer) got from network and the final answer"""
+
+    fetched = []
+    for name, answer in candidates:
+        if answer is None:
+            answer = callSimbadWithRetry(limiter, query_simbad, name)
+            if answer is None:  # failed: don't cache it, it will be asked again next run
+                continue
+            fetched.append((name, answer))
+        if answer[0]:
+            return fetched, answer
+    return fetched, simbadNotFound
+
+def resolveSimbadOnline(stars):
+    """Same as getCoordFromSimbadOnline for every star in stars, with at most simbadMaxWorkers concurrent queries and
+    simbadRequestsPerSecond queries per second. Yield (star, (ra, dec, dist, mag, ids, raDeg, decDeg)) in the order of stars.
+    'simbad_cache' is read and written only by the calling thread"""
+
+    limiter = RateLimiter(0 if cassetteMode == "replay" else simbadRequestsPerSecond)
+    with ThreadPoolExecutor(max_workers=simbadMaxWorkers) as executor:
+        futures = []
+        for star in stars:
+            candidates = []
+            for name in nameVariants(star):
+                cached = getSimbadCache(name, "query_object")
+                candidates.append((name, simbadCacheAnswer(cached) if cached else None))
+            futures.append((star, executor.submit(resolveSimbadOnlineWorker, candidates, limiter)))
+
+        for star, future in futures:
+            fetched, answer = future.result()
+            for name, (ra, dec, distance, mag, ids, raDeg, decDeg) in fetched:
+                putSimbadCache(name, name if ra else None, ra, dec, mag, distance, ids, raDeg, decDeg, "query_object")
+            if answer[0] is None:
+                logging.debug(f"resolveSimbadOnline: no results found for {star}")
+            yield star, answer
+
+def httpSession():
+    """Return the requests.Session shared by all the downloads, created on first use"""
+
+    global httpSessionShared
+    if httpSessionShared is None:
+        import requests
+        import requests.adapters
+        httpSessionShared = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(sources), pool_maxsize=httpPoolSize)
+        httpSessionShared.mount("http://", adapter)
+        httpSessionShared.mount("https://", adapter)
+        httpSessionShared.headers["Accept-Encoding"] = "gzip, deflate"
+    return httpSessionShared
+
+def snapshotPaths(source):
+    """Return the paths of the snapshot of source and of its metadata (ETag, Last-Modified)"""
+
+    return os.path.join(snapshotDir, source), os.path.join(snapshotDir, source + ".json")
+
+def replaySource(source, key):
+    """fetchSource in cassetteMode "replay": write the recorded body of source in a snapshot inside cassetteDir.
+    The snapshots of snapshotDir, used by the real and the offline runs, are left as they are"""
+
+    directory = os.path.join(cassetteDir, "snapshots")
+    path = os.path.join(directory, source)
+    body = getCassette(key)
+    if os.path.exists(path):
+        with open(path, "rb") as snapshot:
+            if snapshot.read() == body:
+                return path, False
+    os.makedirs(directory, exist_ok=True)
+    with open(path + ".part", "wb") as snapshot:
+        snapshot.write(body)
+    os.replace(path + ".part", path)
+    return path, True
+
+def fetchSource(source):
+    """Download source (key of sources) in its snapshot file, asking only for changes since the previous snapshot
+    (If-None-Match/If-Modified-Since). Return (snapshot path, True if the content changed).
+    In offlineMode the last snapshot is used without connecting. In cassetteMode the body is recorded or replayed"""
+
+    logging.info(f"fetchSource: {source}")
+
+    cassetteKey = "http " + sources[source]["url"] + " " + json.dumps(sources[source].get("params"), sort_keys=True)
+    if cassetteMode == "replay":
+        return replaySource(source, cassetteKey)
+    path, changed = downloadSource(source)
+    if cassetteMode == "record":
+        with open(path, "rb") as snapshot:
+            putCassette(cassetteKey, snapshot.read())
+    return path, changed
+
+def downloadSource(source):
+    """fetchSource without cassettes"""
+
+    path, metaPath = snapshotPaths(source)
+    meta = {}
+    if os.path.exists(path) and os.path.exists(metaPath):
+        with open(metaPath, "r", encoding="utf-8") as metaFile:
+            meta = json.load(metaFile)
+
+    if offlineMode:
+        if not meta:
+            print("No snapshot of "+source+" in "+snapshotDir+" for the offline run. Program terminated.")
+            exit()
+        return path, False
+
+    config = sources[source]
+    headers = dict(config.get("headers", {}))
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("lastModified"):
+        headers["If-Modified-Since"] = meta["lastModified"]
+
+    response = httpSession().get(config["url"], params=config.get("params"), headers=headers, stream=True, timeout=httpTimeout)
+    if response.status_code == 304:
+        logging.info(f"fetchSource: {source} not modified")
+        return path, False
+    if not response.ok:
+        print("Download from "+config["url"]+" failed. Program terminated.")
+        logging.error(f"Failed to retrieve data from {config['url']}: {response}")
+        exit()
+
+    os.makedirs(snapshotDir, exist_ok=True)
+    digest = hashlib.sha1()
+    with open(path + ".part", "wb") as snapshot:
+        for chunk in response.iter_content(chunk_size=1 << 16):  # gzip is decoded by requests
+            snapshot.write(chunk)
+            digest.update(chunk)
+    countMetric(source + ".bytes", response.raw.tell())  # as received, before decoding
+    os.replace(path + ".part", path)
+    with open(metaPath, "w", encoding="utf-8") as metaFile:
+        json.dump({"url": response.url, "etag": response.headers.get("ETag"), "lastModified": response.headers.get("Last-Modified"),
+                   "sha1": digest.hexdigest(), "fetched": time.time()}, metaFile)
+    return path, digest.hexdigest() != meta.get("sha1")  # sources without ETag send the same body again
 
 def getDBRow(name):
     sqliteCursor.execute("SELECT name,ra,dec,mag,dist,type,mass,radius,temp,age,metall,planets FROM stars WHERE name = ?",(name, )   )
     row = sqliteCursor.fetchone()
     print(row)
 
-def getDataFromExoplanet(exoplanetLocalFile):
-    """ Get data from Exoplanet.eu catalog and load them on stars.db """
-    
-    logging.info(f"getDataFromExoplanet")
+def csvColumnIndex(header, columns, source):
+    """Return {column: position in header} for every name in columns. Raise ValueError if some column is missing"""
 
-    if(exoplanetLocalFile == None):
-        response = requests.request("GET", "http://exoplanet.eu/catalog/csv/")
-        if not response.ok:
-            print("Download from http://exoplanet.eu failed")
-            exit()
-        LinesExo = response.text.splitlines(True)
-    else:
-        try:
-            fileExo = open(exoplanetLocalFile, "r")
-        except:
-            print("File with data from exoplanet.eu not found")
-            exit(0)
-   
-        next(fileExo) # Skip first line with headers
-        LinesExo = fileExo.readlines()
-   
-    planets = 0  # Variable incremented on every occurrence of the same star
-    star = ''
-    ra=0;dec=0;mag=0;dist=0;spec_type="";mass=0;radius=0;temp=0;age=0;met=0;altNames=""
-    for lineExo in LinesExo:
-        
-        #if "Kepler-451" in lineExo:
-        #    print() 
-                
-        if "\"" in lineExo: # There are fields of type "a, b" that are confused with two different fields. This fix it.
-            tmpExo = lineExo.replace(', ',';')
-        else:
-            tmpExo = lineExo
-        fieldEx = tmpExo.split(",")
+    header = [field.strip() for field in header]
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise ValueError(f"Columns {missing} not found in the header of the data from {source}. Found: {header}")
+    return {column: header.index(column) for column in columns}
 
-        #read check
-        if(len(fieldEx) < 93):
-            print("Error in data from exoplanets: expected at least 92 fields, found",len(fieldEx))
-            print(tmpExo)
-            exit()
+def exoplanetHost(fieldEx, col, log=True):
+    """Return the mother star of the planet in the exoplanet.eu line fieldEx, None if the line is not used"""
 
-        fieldEx[68] = fieldEx[68].rstrip()  # Mother star        
-        if(fieldEx[68] and fieldEx[68] != "Sun" and re.search(r'[A-Z\)\s][a-z]$',fieldEx[0]) is not None): #only valid stars: no the Sun. It means 'Name b' or 'Name AB)b' (at least one planet)
-               
-            planet_mass = float(zeroIfEmpty(fieldEx[2]))
-            if planet_mass > brownDwarfMassLimit:  # no brown dwarfs
-                logging.info(f"{fieldEx[0]} mass is {planet_mass}: excluded as probable brown dwarf")
-            else:
-                if(star and star != fieldEx[68]) : # if it's a new star, save data of the previous one
-                        
-                    if(star == "HS 0705+6700"):
-                        planets = 0 # Possible brown dwarfs system 
-    
-                    if(planets > 1):
-                        sql = '''INSERT INTO stars (name,ra,dec,mag,dist,type,mass,radius,temp,age,metall,planets,altNames) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?);'''
-                        try:
-                            sqliteCursor.execute(sql,(star,ra,dec,mag,dist,spec_type,mass,radius,temp,age,met,planets,altNames))
-                        except sl.Error as err:
-                            print("Insert star "+star+"("+ra,dec+") failed:",err)
-                    planets = 0
-                    dist = 0
-    
-                #save data for next loop           
-                ra = deg_to_hms(fieldEx[69],"RA")
-                dec = deg_to_hms(fieldEx[70],"DEC")
-    
-                if(fieldEx[76]) != '':
-                    dist = round(float(fieldEx[76])*3.261563777,1)  # Convert parsec to light years
-                star=fieldEx[68]
-                spec_type=fieldEx[88]
-                mag = zeroIfEmpty(fieldEx[71])
-                mass = zeroIfEmpty(fieldEx[82])
-                radius = zeroIfEmpty(fieldEx[85])
-                temp = zeroIfEmpty(fieldEx[92])
-                age = zeroIfEmpty(fieldEx[89])
-                met = zeroIfEmpty(fieldEx[79])                
-                altNames = fieldEx[97]
-                planets += 1
+    motherStar = fieldEx[col["star_name"]].rstrip()  # Mother star        
+    if(motherStar and motherStar != "Sun" and re.search(r'[A-Z\)\s][a-z]$',fieldEx[col["name"]]) is not None): #only valid stars: no the Sun. It means 'Name b' or 'Name AB)b' (at least one planet)
+        planet_mass = parseNumber(fieldEx[col["mass"]])
+        if planet_mass > brownDwarfMassLimit:  # no brown dwarfs
+            if log:
+                logging.info(f"{fieldEx[col['name']]} mass is {planet_mass}: excluded as probable brown dwarf")
+            return None
+        return motherStar
+    return None
+
+def exoplanetSystems(linesExo):
+    """Read the exoplanet.eu catalog (csv with header) line by line from linesExo.
+    Yield a StarSystem (dist in pc, without ra and dec) for every multiplanetary system"""
+
+    reader = csv.reader(linesExo)
+    header = next(reader)
+    col = csvColumnIndex(header, exoplanetColumns, "exoplanet.eu")
+
+    system = None  # system of the previous lines, planets incremented on every occurrence of the same star
+    for fieldEx in reader:
+
+        #read check
+        if(len(fieldEx) != len(header)):
+            raise ValueError(f"Error in data from exoplanets: expected {len(header)} fields, found {len(fieldEx)}: {fieldEx}")
+
+        motherStar = exoplanetHost(fieldEx, col)
+        if motherStar:
+            if(system is None or system.name != motherStar) : # if it's a new star, save data of the previous one
+                if(system is not None and system.planets > 1 and system.name != "HS 0705+6700"):  # HS 0705+6700: possible brown dwarfs system
+                    yield system
+                system = StarSystem(motherStar)
+
+            #save data for next loop           
+            system.raDeg = float(fieldEx[col["ra"]])
+            system.decDeg = float(fieldEx[col["dec"]])
+
+            if(fieldEx[col["star_distance"]]) != '':
+                system.dist = float(fieldEx[col["star_distance"]])  # parsec, converted to light years by exoplanetStars
+            system.type = fieldEx[col["star_sp_type"]]
+            system.mag = parseNumber(fieldEx[col["mag_v"]])
+            system.mass = parseNumber(fieldEx[col["star_mass"]])
+            system.radius = parseNumber(fieldEx[col["star_radius"]])
+            system.temp = parseNumber(fieldEx[col["star_teff"]])
+            system.age = parseNumber(fieldEx[col["star_age"]])
+            system.metall = parseNumber(fieldEx[col["star_metallicity"]])
+            system.altNames = fieldEx[col["star_alternate_names"]]
+            system.planets += 1
 
     # Last line
-    if( planets > 1):
+    if(system is not None and system.planets > 1 and system.name != "HS 0705+6700"):
+        yield system
+
+def exoplanetStars(linesExo):
+    """Yield the StarSystem of every multiplanetary system of exoplanetSystems(linesExo), with ra, dec and dist in light years. Coordinates and distances are converted writeBatchSize systems at a time"""
+
+    systems = exoplanetSystems(linesExo)
+    while True:
+        batch = [system for _, system in zip(range(writeBatchSize), systems)]
+        if not batch:
+            return
+        countMetric("getDataFromExoplanet.rowsIn", len(batch))
+        ras = deg_to_hms_array(np.array([system.raDeg for system in batch]), "RA")
+        decs = deg_to_hms_array(np.array([system.decDeg for system in batch]), "DEC")
+        dists = pc2LigthYear_array([system.dist for system in batch], ["pc"]*len(batch))
+        for i, system in enumerate(batch):
+            system.ra = ras[i]
+            system.dec = decs[i]
+            system.dist = float(dists[i])
+            yield system
+
+def exoplanetGroupStart(fileBin, offset, col, fieldsCount):
+    """Return the offset of the first line after offset with a host star different from the one of the previous used line,
+    where exoplanetSystems starts a new system. None if there isn't"""
+
+    fileBin.seek(offset)
+    fileBin.readline()  # rest of the line of offset
+    previous = None
+    while True:
+        position = fileBin.tell()
+        line = fileBin.readline()
+        if not line:
+            return None
+        fieldEx = next(csv.reader([line.decode("utf-8")]), [])
+        if len(fieldEx) != fieldsCount:
+            continue
+        try:
+            motherStar = exoplanetHost(fieldEx, col, log=False)
+        except ValueError:
+            continue
+        if motherStar:
+            if previous is not None and motherStar != previous:
+                return position
+            previous = motherStar
+
+def exoplanetChunks(path, chunks):
+    """Split the exoplanet.eu catalog path in at most chunks byte ranges starting with a new system: return (header, [(start, end)])"""
+
+    with open(path, "rb") as fileBin:
+        header = fileBin.readline().decode("utf-8")
+        size = os.fstat(fileBin.fileno()).st_size
+        fields = next(csv.reader([header]))
+        col = csvColumnIndex(fields, exoplanetColumns, "exoplanet.eu")
+        starts = [len(header.encode("utf-8"))]
+        for i in range(1, chunks):
+            start = exoplanetGroupStart(fileBin, max(i*size//chunks, starts[-1]), col, len(fields))
+            if start is None:
+                break
+            if start > starts[-1]:
+                starts.append(start)
+    return header, list(zip(starts, starts[1:] + [size]))
+
+def exoplanetChunkRows(path, header, start, end):
+    """Return the rows of 'stars' (StarSystem.row(), cheaper to send back) of the bytes start-end of the exoplanet.eu catalog path
+    (see exoplanetChunks). Run in the processes of exoplanetStarsParallel"""
+
+    with open(path, "rb") as fileBin:
+        fileBin.seek(start)
+        text = fileBin.read(end - start).decode("utf-8")
+    return [system.row() for system in exoplanetStars([header] + list(io.StringIO(text, newline='')))]
+
+def exoplanetStarsParallel(path, workers):
+    """Same systems of exoplanetStars for the exoplanet.eu catalog path, parsed by workers processes in byte ranges of at least parseChunkBytes"""
+
+    chunks = min(workers*4, os.path.getsize(path) // parseChunkBytes)
+    header, ranges = exoplanetChunks(path, chunks) if chunks > 1 else (None, [])
+    if len(ranges) > 1:
+        logging.info(f"exoplanetStarsParallel: {len(ranges)} byte ranges parsed by {workers} processes")
         try:
-            sqliteCursor.execute(sql,(star,ra,dec,mag,dist,spec_type,mass,radius,temp,age,met,planets,altNames))
-        except sl.Error as err:
-            print(sql,err)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunkRows = list(executor.map(exoplanetChunkRows, [path]*len(ranges), [header]*len(ranges), *zip(*ranges)))
+            for rows in chunkRows:
+                countMetric("getDataFromExoplanet.rowsIn", len(rows))
+                for row in rows:
+                    yield StarSystem(*row)
+            return
+        except ValueError as err:  # e.g. a field with a new line: let the sequential parsing decide
+            logging.warning(f"exoplanetStarsParallel: {err}. Parsing the catalog in one process")
+
+    yield from exoplanetStarsFile(path)
+
+def exoplanetStarsFile(path):
+    """exoplanetStars of the exoplanet.eu catalog path, closed at the end"""
+
+    with open(path, "r", encoding="utf-8", newline='') as linesExo:
+        yield from exoplanetStars(linesExo)
+
+def getDataFromExoplanet(exoplanetLocalFile):
+    """ Get data from Exoplanet.eu catalog and load them on stars.db """
+    
+    logging.info(f"getDataFromExoplanet")
+
+    if(exoplanetLocalFile == None):
+        exoplanetLocalFile = fetchSource("exoplanet")[0]
+    starsBuffer = WriteBuffer("INSERT INTO stars (" + ",".join(StarSystem.__slots__) + ") VALUES(" + ",".join("?"*len(StarSystem.__slots__)) + ");")
+    try:
+        for system in exoplanetStarsParallel(exoplanetLocalFile, parseWorkers) if parseWorkers > 1 else exoplanetStarsFile(exoplanetLocalFile):
+            starsBuffer.add(system.row())
+        starsBuffer.flush()
+    except OSError:
+        print("File with data from exoplanet.eu not found")
+        exit(0)
+    except ValueError as err:
+        print(err)
+        exit()
+    except sl.Error as err:
+        print("Insert in 'stars' table of data from exoplanet.eu failed:",err)
 
     # Systems listed by NASA and not by Exoplanet.eu
     #try:
@@ -244,6 +1184,96 @@ def getDataFromExoplanet(exoplanetLocalFile):
 
     sqliteConn.commit()
 
+def query_objects_batch(names):
+    """Simbad.query_objects for names, run in the threads of getDataFromSimbadSite"""
+    return configuredSimbad().query_objects(names)
+
+def query_objects_tap(names):
+    """Same table of Simbad.query_objects for names with one round-trip to the TAP service simbadTapUrl: names are uploaded
+    as a VOTable and joined with ident, basic, ids, allfluxes and mesDistance by simbadTapQuery. Recorded/replayed in cassetteMode"""
+
+    from astropy.table import Table, MaskedColumn
+    from astropy.io import votable
+
+    key = "simbad tap " + json.dumps([simbadTapUrl, list(names)])
+    if cassetteMode == "replay":
+        return getCassette(key)
+
+    upload = io.BytesIO()
+    votable.from_table(Table({"name": list(names)})).to_xml(upload)
+    response = httpSession().post(simbadTapUrl, timeout=httpTimeout,
+                                  data={"REQUEST": "doQuery", "LANG": "ADQL", "FORMAT": "votable", "QUERY": simbadTapQuery, "UPLOAD": "names,param:names"},
+                                  files={"names": ("names.xml", upload.getvalue(), "application/x-votable+xml")})
+    response.raise_for_status()
+    countMetric("simbad_tap.bytes", len(response.content))
+    found = {}
+    for row in votable.parse_single_table(io.BytesIO(response.content)).to_table():
+        found.setdefault(str(row["name"]), row)  # one row for every distance of the object: the first one is used
+
+    rows = [found.get(name) for name in names]
+    def column(field, empty, dtype=float):  # float64 as query_objects: sqlite3 would save the float32 of a REAL column as a BLOB
+        masked = [row is None or np.ma.is_masked(row[field]) for row in rows]
+        values = [empty if mask else dtype(str(row[field])) for row, mask in zip(rows, masked)]  # str: 10.2, not 10.199999809
+        return MaskedColumn(values, mask=masked, dtype=dtype)
+    result = Table({"main_id": ["" if row is None else str(row["main_id"]) for row in rows],
+                    "ra": column("ra", 0.0), "dec": column("dec", 0.0),
+                    "mesdistance.dist": column("dist", 0.0), "mesdistance.unit": column("unit", "", str),
+                    "V": column("V", 0.0),
+                    "ids": ["" if row is None or np.ma.is_masked(row["ids"]) else str(row["ids"]) for row in rows],
+                    "user_specified_id": list(names)})
+    if cassetteMode == "record":
+        putCassette(key, result)
+    return result
+
+def simbadBatchRows(result):
+    """Put the query_objects result in 'simbad_cache' and return its rows (name,ra,dec,mag,dist,ids,raDeg,decDeg) for 'simbad'"""
+
+    rows = []
+    ras = deg_to_hms_array(result['ra'], "RA")
+    decs = deg_to_hms_array(result['dec'], "DEC")
+    distances = pc2LigthYear_array(result['mesdistance.dist'], result['mesdistance.unit'])
+    for i, row in enumerate(result):
+        if(row['main_id'] != ''): # if name is empty, it's a wrong record
+            name = re.sub(r'^\*\s{1,2}', '', row['main_id']) #drop leading asterisks and spaces
+            name = re.sub(r'^NAME\s+', '', name)  # Remove "NAME " from the beginning of the name
+
+            ra = ras[i]
+            dec = decs[i]
+            distance = float(distances[i])
+            mag = row['V']
+            if not mag:
+                mag = 0
+            ids = re.sub(r'\|\*\s{1,2}', '|', row['ids'])  #drop leading asterisks and spaces
+            ids = re.sub(r'NAME\s+', '', ids)  # Remove "NAME " from the name
+            ids = name + "|" + ids
+
+            raDeg = float(row['ra'])
+            decDeg = float(row['dec'])
+
+            putSimbadCache(row['user_specified_id'], name, ra, dec, mag, distance, ids, raDeg, decDeg)
+            rows.append((name, ra, dec, mag, distance, ids, raDeg, decDeg))
+        else:
+            putSimbadCache(row['user_specified_id'], None, None, None, 0, 0, None, None, None)  # unknown to Simbad
+    return rows
+
+def insertSimbadRows(rows, seen):
+    """Put rows (name,ra,dec,mag,dist,ids,raDeg,decDeg) in 'simbad' and 'simbad_ids'.
+    seen is the set of coordinates already in 'simbad': rows with the same coordinates are the same object, ignored"""
+
+    simbadBuffer = WriteBuffer('''INSERT INTO simbad (name,ra,dec,mag,dist,ids,raDeg,decDeg) VALUES(?,?,?,?,?,?,?,?);''')
+    idsBuffer = WriteBuffer("INSERT OR IGNORE INTO simbad_ids (id,ra,dec) VALUES(?,?,?);")
+    for name, ra, dec, mag, distance, ids, raDeg, decDeg in rows:
+        if (ra, dec) in seen: #Ignore duplicated
+            continue
+        seen.add((ra, dec))
+        simbadBuffer.add((name,ra,dec,mag,distance,ids,raDeg,decDeg))
+        idsBuffer.extend(simbadIdRows(ra, dec, ids))
+    try:
+        simbadBuffer.flush()
+        idsBuffer.flush()
+    except sl.Error as err:
+        print("Insert in 'simbad' table failed:",err)
+
 def getDataFromSimbadSite():
     """
     Fetches star data from the Simbad astronomical database and updates the local database for coordinates distance (in pc) and magnitude.
@@ -254,366 +1284,674 @@ def getDataFromSimbadSite():
     logging.info(f"getDataFromSimbadSite") 
    
     #Get data already downloaded from Exoplanets.eu
-    sqliteCursor.execute("SELECT name FROM stars")
-    starsRows = sqliteCursor.fetchall()
-    query = []
-    for row in starsRows:
-        name = row[0]
-        query.append(name)
+    systems = list(selectStars())
+    query = [system.name for system in systems]
 
     query.extend(peculiar_star_names.values())
-
-    Simbad.add_votable_fields('mesdistance','V','ids')  
-    result = Simbad.query_objects(query)
-
-    #put Simbad results in local db (table 'simbad')
-    for row in result:
-        sql = '''INSERT INTO simbad (name,ra,dec,mag,dist,ids) VALUES(?,?,?,?,?,?);'''
-
-        if(row['main_id'] != ''): # if name is empty, it's a wrong record
-            name = re.sub(r'^\*\s{1,2}', '', row['main_id']) #drop leading asterisks and spaces
-            name = re.sub(r'^NAME\s+', '', name)  # Remove "NAME " from the beginning of the name
-
-            ra = deg_to_hms(row['ra'], "RA")
-            dec = deg_to_hms(row['dec'], "DEC")
-            distance = pc2LigthYear(row['mesdistance.dist'], row['mesdistance.unit'])
-            mag = result['V'][0]
-            if not mag:
-                mag = 0
-            ids = re.sub(r'\|\*\s{1,2}', '|', result['ids'][0])  #drop leading asterisks and spaces
-            ids = re.sub(r'NAME\s+', '', ids)  # Remove "NAME " from the name
-            ids = re.sub(r'\|\*\s{1,2}', '|', row['ids'])  #drop leading asterisks and spaces
-            ids = re.sub(r'NAME\s+', '', ids)  # Remove "NAME " from the name
-            ids = name + "|" + ids
-
-            try:
-                sqliteCursor.execute(sql,(name,ra,dec,mag,distance,ids))
-            except sl.Error as err:
-                if("UNIQUE constraint failed" not in err.args[0]): #Ignore duplicated
-                    print("Insert star "+name+"("+ra,dec+") failed:",err)
-    
+    countMetric("getDataFromSimbadSite.rowsIn", len(query))
+
+    #ask Simbad only for names never asked or with a stale answer in 'simbad_cache'
+    cachedRows = []
+    toQuery = []
+    for name in dict.fromkeys(query):
+        cached = getSimbadCache(name)
+        if cached is None:
+            toQuery.append(name)
+        elif cached[0] is not None:
+            cachedRows.append(cached)
+    logging.info(f"getDataFromSimbadSite: {len(query) - len(toQuery)} names from cache, {len(toQuery)} to query")
+
+    seen = set()
+    insertSimbadRows(cachedRows, seen)
     sqliteConn.commit()
 
-    # double check 'simbad' table
-    for row in starsRows:
-        #Search in 'simbad' table if star is correctly present
-        ra, dec, dist, mag, ids = getCoordFromSimbadLocalTable(row[0])
-        if(ra == None): # if not found in Simbad local DB try again online. It's more efficient in finding names
+    #query Simbad in batches of simbadBatchSize names. Every batch is committed in 'simbad_cache' and 'simbad' as soon as it's
+    #processed, so an interrupted run restarts from the first unfinished batch: the names of the others are in the cache
+    batchSize = simbadBatchSize if simbadBatchSize > 0 and simbadResolver != "tap" else max(len(toQuery), 1)
+    batches = [toQuery[i:i + batchSize] for i in range(0, len(toQuery), batchSize)]
+    queryBatch = query_objects_tap if simbadResolver == "tap" else query_objects_batch
+    limiter = RateLimiter(0 if cassetteMode == "replay" else simbadRequestsPerSecond)
+    with ThreadPoolExecutor(max_workers=simbadBatchWorkers) as executor:
+        futures = [executor.submit(callSimbadWithRetry, limiter, queryBatch, batch) for batch in batches]
+        for i, future in enumerate(futures):
+            result = future.result()
+            if result is None:
+                logging.error(f"getDataFromSimbadSite: batch {i + 1}/{len(batches)} failed, its names will be asked again next run")
+                continue
+            insertSimbadRows(simbadBatchRows(result), seen)
+            sqliteConn.commit()
+            logging.info(f"getDataFromSimbadSite: batch {i + 1}/{len(batches)} of {len(batches[i])} names saved")
 
-            ra, dec, dist, mag, ids = getCoordFromSimbadOnline(row[0])
+    # double check 'simbad' table
+    #Search in 'simbad' table if star is correctly present, if not found in Simbad local DB try again online. It's more efficient in finding names
+    missing = [system.name for system in systems if getCoordFromSimbadLocalTable(system.name)[0] == None]
+    for star, (ra, dec, dist, mag, ids, raDeg, decDeg) in resolveSimbadOnline(missing):
+        if(getCoordFromSimbadLocalTable(star)[0] != None):  # meanwhile added as synonym of a previous star
+            continue
 
-            if(ra != None): #if found, check if already present with different ids and update 'simbad' table ids. Otherwise insert new row
-                try:
-                    # Check for star with this new found ids (synonyms)
-                    sqliteCursor.execute("SELECT name FROM simbad WHERE ids LIKE ?", ('%' + ids + '%',))
-                    synonymIds = sqliteCursor.fetchone()
-                    ids = row[0] + "|" + ids
-                    update = False
-                    if synonymIds: #if found, add the name as new id
-                        sqliteCursor.execute("UPDATE simbad SET ids=? WHERE name=?;",(ids,synonymIds[0]))
-                        logging.debug(f"Star {synonymIds[0]} data updated with data from Simbad")
+        if(ra != None): #if found, check if already present with different ids and update 'simbad' table ids. Otherwise insert new row
+            try:
+                # Check for star with this new found ids (synonyms)
+                keys = list(set(normalizeId(identifier) for identifier in ids.split("|") if identifier.strip()))
+                sqliteCursor.execute("SELECT ra, dec FROM simbad_ids WHERE id IN (" + ",".join("?" * len(keys)) + ") LIMIT 1", keys)
+                synonymIds = sqliteCursor.fetchone()
+                ids = star + "|" + ids
+                update = False
+                if synonymIds: #if found, add the name as new id
+                    sqliteCursor.execute("UPDATE simbad SET ids=? WHERE ra=? AND dec=?;",(ids,synonymIds[0],synonymIds[1]))
+                    indexSimbadIds(synonymIds[0], synonymIds[1], ids)
+                    logging.debug(f"Star of coordinates {synonymIds[0]} and {synonymIds[1]} updated with data from Simbad")
+                    update = True
+                else: # otherwise check for star with this new found coordinats (synonyms)
+                    synonymCoord = nearestCoords("simbad", raDeg, decDeg, simbadMatchTolerance)
+                    if synonymCoord:
+                        sqliteCursor.execute("SELECT ra, dec FROM simbad WHERE rowid=?", (synonymCoord[0],))
+                        synonymRa, synonymDec = sqliteCursor.fetchone()
+                        sqliteCursor.execute("UPDATE simbad SET ids=? WHERE rowid=?",(ids,synonymCoord[0]))
+                        indexSimbadIds(synonymRa, synonymDec, ids)
+                        logging.debug(f"Star of coordinates {synonymRa} and {synonymDec} updated with data from Simbad ({synonymCoord[1]:.1f} arcsec)")
                         update = True
-                    else: # otherwise check for star with this new found coordinats (synonyms)
-                        sqliteCursor.execute("SELECT name, ra, dec FROM simbad WHERE ra=? AND dec=?", (ra,dec))
-                        synonymCoord = sqliteCursor.fetchone()
-                        if synonymCoord:
-                            sqliteCursor.execute("UPDATE simbad SET ids=? WHERE ra=? AND dec=?",(ids,ra,dec))
-                            logging.debug(f"Star of coordinates {ra} and {dec} updated with data from Simbad")
-                            update = True
-                    if not update: # otherwise insert new row
-                        if not mag:
-                            mag = 0
-                        sqliteCursor.execute("INSERT INTO simbad (name,ra,dec,mag,dist,ids) VALUES(?,?,?,?,?,?);",
-                                (row[0],ra,dec,mag,dist,ids))
-                        logging.debug(f"Star {row[0]} inserted in simbad table")
-                except sl.Error as err:
-                    print("Update/insert in 'simbad' table with online Simbad data for",row[0],"failed:",err)
+                if not update: # otherwise insert new row
+                    if not mag:
+                        mag = 0
+                    sqliteCursor.execute("INSERT INTO simbad (name,ra,dec,mag,dist,ids,raDeg,decDeg) VALUES(?,?,?,?,?,?,?,?);",
+                            (star,ra,dec,mag,dist,ids,raDeg,decDeg))
+                    indexSimbadIds(ra, dec, ids)
+                    logging.debug(f"Star {star} inserted in simbad table")
+            except sl.Error as err:
+                print("Update/insert in 'simbad' table with online Simbad data for",star,"failed:",err)
 
-        sqliteConn.commit()
+    sqliteConn.commit()
 
     # Update 'star' table with data from 'simbad' table
-    for row in starsRows:
-        ra, dec, dist, mag, ids = getCoordFromSimbadLocalTable(row[0])
-        if(ra != None):
-            # If found, update 'star' table
-            sqlStars = """
+    starsBuffer = WriteBuffer("""
                 UPDATE stars
                 SET dist = CASE WHEN dist = 0 OR dist IS NULL OR dist = '' THEN ? ELSE dist END,
                     mag = CASE WHEN mag = 0 OR mag IS NULL OR mag = '' THEN ? ELSE mag END,
                     ra = ?,
-                    dec = ?
+                    dec = ?,
+                    raDeg = ?,
+                    decDeg = ?
                 WHERE name = ?;
-            """
-            try:
-                sqliteCursor.execute(sqlStars,(dist,mag,ra,dec,row[0]))
-                logging.debug(f"Star {row[0]} data updated with data from Simbad")
-            except sl.Error as err:
-                print("Update 'stars' table with Simbad data for",row[0],"failed:",err)
+            """)
+    for system in systems:
+        ra, dec, dist, mag, ids, raDeg, decDeg = getCoordFromSimbadLocalTable(system.name)
+        if(ra != None):
+            # If found, update 'star' table
+            starsBuffer.add((dist,mag,ra,dec,raDeg,decDeg,system.name))
+            logging.debug(f"Star {system.name} data updated with data from Simbad")
         else:
-            logging.info(f"Star {row[0]} not present in Simbad")
+            logging.info(f"Star {system.name} not present in Simbad")
+    try:
+        starsBuffer.flush()
+    except sl.Error as err:
+        print("Update 'stars' table with Simbad data failed:",err)
 
     sqliteConn.commit()
+    global nameResolverShared
+    nameResolverShared = None  # built again with the new Simbad ids
 
 def getDataFromNASA(nasaLocalFile):
-    """ Get data from NASA's catalog and add them on stars.db """
+    """ Get data from NASA's catalog and fill with them the data missing in stars.db """
 
     logging.info(f"getDataFromNASA")
     
     if(nasaLocalFile == None):
-        response = requests.request("GET", "https://exoplanetarchive.ipac.caltech.edu/TAP/sync?query=select+hostname,ra,dec,sy_vmag,sy_dist,st_spectype,st_mass,st_rad,st_teff,st_age,st_met+from+pscomppars&format=csv")
-        if not response.ok:
-            print("Download from https://exoplanetarchive.ipac.caltech.edu failed")
-            exit()
-        #linesNASAtmp = response.text.splitlines(True)
-        #linesNASA = (list(set(linesNASAtmp)))
-        linesNASA = (list(set(response.text.splitlines(True)))) #split resulting text in lines and eliminate duplicates
-    else:
+        nasaLocalFile = fetchSource("nasa")[0]
+    try:
+        fileNASA = open(nasaLocalFile, "r", encoding="utf-8", newline='')
+    except:
+        print("File with data from exoplanetarchive.ipac.caltech.edu not found")
+        exit(0)
+
+    # match every line with 'stars' through an index built once, and keep for every star the first not empty value of every field
+    index = StarsIndex()
+    updates = {}  # rowid of 'stars' -> [mag,dist,type,mass,radius,temp,age,metall]
+    with fileNASA:
+        reader = csv.reader(fileNASA)
         try:
-            fileNASA = open(nasaLocalFile, "r")
-        except:
-            print("File with data from exoplanetarchive.ipac.caltech.edu not found")
-            exit(0)
-   
-        next(fileNASA) # Skip first line with headers
-        linesNASA = fileNASA.readlines()
-
-    for lineNASA in linesNASA:   
-        #ts = datetime.timestamp(datetime.now())
-        fieldNASA = lineNASA.strip("'").rstrip('\n').split(",")
-    
-        name = fieldNASA[0].strip('"')
-        if(name == "hostname"): #Skip line with headers
-            continue
-
-        dist = 0
-        if(fieldNASA[4] != ''):
-            try:
-                dist = round(float(fieldNASA[4])*3.261563777,1)  # Convert parsec to light years
-            except:
-                print(fieldNASA[4])
-                print()
-
-        sqliteCursor.execute("SELECT * FROM stars WHERE name = ?",(name, ) )
-        rowForName = sqliteCursor.fetchone()
-        if(rowForName is None):# name not found. Try to update by coordinates
-            ra, dec, distSimbad, mag, ids = getCoordFromSimbadLocalTable(name)
-            sql = "UPDATE stars SET mag=COALESCE(NULLIF(mag,0),?),dist=COALESCE(NULLIF(dist,''),?),type=COALESCE(NULLIF(type,''),?),mass=COALESCE(NULLIF(mass,''),?),radius=COALESCE(NULLIF(radius,''),?),temp=COALESCE(NULLIF(temp,''),?),age=COALESCE(NULLIF(age,''),?),metall=COALESCE(NULLIF(metall,''),?)  WHERE ra=? AND dec=?;"
-            try:
-                sqliteCursor.execute(sql,(fieldNASA[3],dist,fieldNASA[5],fieldNASA[6],fieldNASA[7],fieldNASA[8],fieldNASA[9],fieldNASA[10],ra, dec))
-                logging.debug(f"Star of coordinates RA:{ra},DEC:{dec} updated with data from NASA")
-            except sl.Error as err:
-                print("Update NASA data to",name,"failed:",err)
-                logging.error(f"Update NASA data to {name} failed: {err}")
+            col = csvColumnIndex(next(reader, []), nasaColumns, "exoplanetarchive.ipac.caltech.edu")
+        except ValueError as err:
+            print(err)
+            exit()
 
-        else: #udate by name
-            sql = "UPDATE stars SET mag=COALESCE(NULLIF(mag,0),?),dist=COALESCE(NULLIF(dist,''),?),type=COALESCE(NULLIF(type,''),?),mass=COALESCE(NULLIF(mass,''),?),radius=COALESCE(NULLIF(radius,''),?),temp=COALESCE(NULLIF(temp,''),?),age=COALESCE(NULLIF(age,''),?),metall=COALESCE(NULLIF(metall,''),?)  WHERE name=?;"
+        rowsIn = 0
+        for fieldNASA in reader:
+            rowsIn += 1
+            name = fieldNASA[col["hostname"]]
             try:
-                sqliteCursor.execute(sql,(fieldNASA[3],dist,fieldNASA[5],fieldNASA[6],fieldNASA[7],fieldNASA[8],fieldNASA[9],fieldNASA[10],name))
-                logging.debug(f"Star {name} updated with data from NASA")
-            except sl.Error as err:
-                print("Update 'stars' tables with NASA data for ",name,"failed:",err)
-                logging.error(f"Update 'stars' tables with NASA data for {name} failed: {err}")
+                raDeg, decDeg = float(fieldNASA[col["ra"]]), float(fieldNASA[col["dec"]])
+            except ValueError:  # no coordinates
+                raDeg = decDeg = None
+            match = index.match(name, raDeg, decDeg)
+            if match is None:
+                continue
+
+            dist = None
+            if(fieldNASA[col["sy_dist"]] != ''):
+                try:
+                    dist = round(float(fieldNASA[col["sy_dist"]])*3.261563777,1)  # Convert parsec to light years
+                except ValueError:
+                    logging.warning(f"getDataFromNASA: distance {fieldNASA[col['sy_dist']]} of {name} is not a number")
+            values = [fieldNASA[col["sy_vmag"]] or None, dist] + [fieldNASA[col[column]] or None for column in nasaColumns[5:]]
+            previous = updates.get(match[0])
+            updates[match[0]] = values if previous is None else [old if old is not None else new for old, new in zip(previous, values)]
+            if match[1] > 0:
+                logging.debug(f"Star {name} of NASA matched by coordinates RA:{raDeg},DEC:{decDeg} (at {match[1]:.1f} arcsec)")
+    countMetric("getDataFromNASA.rowsIn", rowsIn)
+    logging.info(f"getDataFromNASA: {rowsIn} lines, {len(updates)} stars of 'stars' matched")
+
+    # fill the empty fields of all the matched stars with one statement
+    sqliteCursor.execute("DROP TABLE IF EXISTS temp.nasa_updates")
+    sqliteCursor.execute("CREATE TEMP TABLE nasa_updates (id INTEGER PRIMARY KEY, mag, dist, type, mass, radius, temp, age, metall)")
+    updatesBuffer = WriteBuffer("INSERT INTO nasa_updates (id,mag,dist,type,mass,radius,temp,age,metall) VALUES(?,?,?,?,?,?,?,?,?);")
+    updatesBuffer.extend([rowid] + values for rowid, values in updates.items())
+    try:
+        updatesBuffer.flush()
+        sqliteCursor.execute("""UPDATE stars SET mag=COALESCE(NULLIF(stars.mag,0),u.mag,stars.mag),dist=COALESCE(NULLIF(stars.dist,0),u.dist,stars.dist),
+                                type=COALESCE(NULLIF(stars.type,''),u.type,stars.type),mass=COALESCE(NULLIF(stars.mass,0),u.mass,stars.mass),
+                                radius=COALESCE(NULLIF(stars.radius,0),u.radius,stars.radius),temp=COALESCE(NULLIF(stars.temp,0),u.temp,stars.temp),
+                                age=COALESCE(NULLIF(stars.age,0),u.age,stars.age),metall=COALESCE(NULLIF(stars.metall,0),u.metall,stars.metall)
+                                FROM nasa_updates u WHERE stars.rowid = u.id""")
+    except sl.Error as err:
+        print("Update 'stars' tables with NASA data failed:",err)
+        logging.error(f"Update 'stars' tables with NASA data failed: {err}")
+    sqliteCursor.execute("DROP TABLE temp.nasa_updates")
 
     sqliteConn.commit()
 
+wikiTemplate = "Stelle con pianeti extrasolari confermati"  # template of a row of the table in the Wikipedia page
+wikiTokenRe = re.compile(r'\{\{|\}\}|\[\[|\]\]|<ref[^>]*/>|<ref[^>]*>.*?</ref>|\|', re.DOTALL)  # a reference is one token
+wikiRefRe = re.compile(r'<ref[^>]*/>|<ref[^>]*>.*?</ref>', re.DOTALL)
+wikiBracesRe = re.compile(r'\{\{|\}\}')
+
+def splitWikiParams(text):
+    """Split the text of a template call (without the outer braces) at the | outside nested templates, links and references"""
+
+    parts = []
+    depth = 0
+    start = 0
+    for token in wikiTokenRe.finditer(text):
+        value = token.group()
+        if value in ("{{", "[["):
+            depth += 1
+        elif value in ("}}", "]]"):
+            depth = max(depth - 1, 0)
+        elif value == "|" and depth == 0:
+            parts.append(text[start:token.start()])
+            start = token.end()
+    parts.append(text[start:])
+    return parts
+
+def wikiTemplates(stream, template):
+    """Yield the text inside the braces of every call of template in the wikitext stream, read in one pass (a call can span lines)"""
+
+    openRe = re.compile(r'\{\{\s*' + re.escape(template) + r'\s*(?=[|}]|$)')
+    parts = None  # text of the call being read
+    depth = 0
+    for line in stream:
+        pos = 0
+        while True:
+            if parts is None:
+                found = openRe.search(line, pos)
+                if found is None:
+                    break
+                parts = [line[found.start() + 2:found.end()]]
+                depth = 1
+                pos = found.end()
+            brace = wikiBracesRe.search(line, pos)
+            if brace is None:
+                parts.append(line[pos:])
+                break
+            depth += 1 if brace.group() == "{{" else -1
+            if depth == 0:
+                parts.append(line[pos:brace.start()])
+                yield "".join(parts)
+                parts = None
+            else:
+                parts.append(line[pos:brace.end()])
+            pos = brace.end()
+
+def wikiNumber(value):
+    """Return the number written in value (decimal comma, unicode minus), value itself if it's not a number, None if empty or '-'"""
+
+    if value is None or value in ('', '-'):
+        return None
+    try:
+        return float(value.replace(',', '.').replace('−', '-'))
+    except ValueError:
+        return value
+
+def wikiCoordinate(value, cooType):
+    """Return in degrees the coordinate written as {{RA|h|m|s}} or {{DEC|d|m|s}}, None if missing or malformed"""
+
+    if not value or not value.startswith("{{") or not value.endswith("}}"):
+        return None
+    fields = [field.strip().replace(',', '.').replace('−', '-') for field in splitWikiParams(value[2:-2])[1:]]
+    try:
+        return hms_to_deg("|".join(fields[:3]), cooType)
+    except (ValueError, IndexError):
+        return None
+
+def wikiRows(stream):
+    """Yield a record {parameter: value} for every row of the table in the Wikipedia page stream. Numbers and coordinates
+    (in degrees) are converted; 'Stella' is the name without the brackets of the link, 'name' the star linked, without
+    references, 'ref' is True if the row has a reference"""
+
+    for text in wikiTemplates(stream, wikiTemplate):
+        params = {}
+        for part in splitWikiParams(text)[1:]:
+            if "=" in part:
+                key, value = part.split("=", 1)
+                params[key.strip()] = value.strip()
+        star = params.get("Stella", "").replace('[[', '').replace(']]', '')
+        record = {parameter: wikiNumber(value) for parameter, value in params.items()}
+        record["Stella"] = star
+        record["Tipo spettrale"] = params.get("Tipo spettrale") if params.get("Tipo spettrale") not in ('', '-') else None
+        record["Ascensione retta"] = wikiCoordinate(params.get("Ascensione retta"), "RA")
+        record["Declinazione"] = wikiCoordinate(params.get("Declinazione"), "DEC")
+        record["name"] = wikiRefRe.sub("", star).split("|")[0].strip()  # Appearing name, not internal link
+        record["ref"] = "<ref" in text
+        yield record
+
 def getDataFromWikipedia(wikiLocalFile):
     """ Get data from Wikipedia's page and add them on stars.db """
 
     logging.debug(f"getDataFromWikipedia")
     
     if(wikiLocalFile == None):
-        url = "https://it.wikipedia.org/w/index.php"
-        params = {
-            "action": "raw",
-            "title": "Sistemi_multiplanetari"
-        }
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                          "AppleWebKit/537.36 (KHTML, like Gecko) "
-                          "Chrome/58.0.3029.110 Safari/537.3",
-            "Accept": "text/plain; charset=utf-8"
-        }
-
-        response = requests.get(url, params=params, headers=headers, timeout=30)
-        if not response.ok:
-            print("Download from https://it.wikipedia.org/w/index.php?action=raw&title=Sistemi_multiplanetari failed. Program terminated.")
-            logging.error(f"Failed to retrieve data from Wikipedia: {response}")
-            exit()
-        fileWikiRaw = response.text.splitlines(True)
-    #else:
-    #   try:
-    #      fileNASA = open(wikiLocalFile, "r")
-    #   except:
-    #      print("File with data from exoplanetarchive.ipac.caltech.edu not found")
-    #      exit(0)
-
-    #with codecs.open(wikiLocalFile, encoding='utf-8') as fileWikiRaw:
-        for lineWikiRaw in fileWikiRaw:
-            if "Stella" in lineWikiRaw:  # put wiki data in fieldWR 
-                tmpWiki = lineWikiRaw.replace('||',';').replace(',','.').replace('−','-')[1:].rstrip('}}\n')  #Template sep || -> ; and dec sep , -> .
-                fieldWR = tmpWiki.split(";")
-
-                #Split values from names
-                valsWiki = []
-                for i in range(11):
-                    tmp = fieldWR[i].split("=")[1]
-                    if(tmp != '-' and tmp != ''):
-                        valsWiki.append(tmp)
+        wikiLocalFile = fetchSource("wikipedia")[0]
+
+    sqlUpd = "UPDATE stars SET name=?,mag=COALESCE(NULLIF(mag,0),?),dist=COALESCE(NULLIF(dist,0),?),type=COALESCE(NULLIF(type,''),?),mass=COALESCE(NULLIF(mass,0),?),radius=COALESCE(NULLIF(radius,0),?),temp=COALESCE(NULLIF(temp,0),?),age=COALESCE(NULLIF(age,0),?),metall=COALESCE(NULLIF(metall,0),?) WHERE rowid=?"
+    resolver = nameResolver()
+    with open(wikiLocalFile, "r", encoding="utf-8") as fileWikiRaw:
+        for record in wikiRows(fileWikiRaw):
+            countMetric("getDataFromWikipedia.rowsIn")
+            name = record["name"]
+            if record["ref"]:
+                logging.warning(f"A reference is present in {name}. Check that it's correctly reported.")
+                print("A reference is present in "+name+". Check that it's correctly reported.")
+
+            # Search the star in 'stars' by name or alias, otherwise the nearest to the coordinates of Simbad(name)
+            # or of the wiki, otherwise the first whose name starts with the wiki one
+            rowid = resolver.resolve(name)
+            if rowid is None:
+                ra, dec, distSimbad, mag, ids, raDeg, decDeg = getCoordFromSimbadLocalTable(name)
+                if(ra == None): # if not found in Simbad, use wiki data
+                    raDeg = record["Ascensione retta"]
+                    decDeg = record["Declinazione"]
+                match = nearestCoords("stars", raDeg, decDeg)
+                if match:
+                    rowid = match[0]
+                    logging.debug(f"Star {name} of Wikipedia matched at {match[1]:.1f} arcsec")
+            if rowid is None:
+                rowid = resolver.startsWith(name)
+
+            system = next(selectStars("WHERE rowid=?", (rowid,)), None) if rowid is not None else None
+
+            # UPDATE WHERE not empty or not too different
+            if(system is None):  #It's in wiki, not in 'stars' db. Maybe ther is a problem
+                raW = deg_to_hms(record["Ascensione retta"], "RA") if record["Ascensione retta"] is not None else None
+                decW = deg_to_hms(record["Declinazione"], "DEC") if record["Declinazione"] is not None else None
+                logging.info(f"Star {name} with coordinates RA:{raW}, DEC:{decW} is in current wiki, but not valid (not existent or less then 2 valid planets)") 
+                print("Star",name,"with coordinates RA:",raW,"DEC:",decW," is in current wiki, but not valid (not existent or less then 2 valid planets)") 
+            else:
+                # Use wiki name and data if not null
+                distStars = system.dist  #dist in 'stars'
+                dist = record.get("Distanza")  #dist in Wiki
+                if(distStars != "" and distStars != None and distStars > 0):
+                    if(isinstance(dist, float) and abs(dist - float(distStars)) > 1000):  # Too different. Maybe there is a problem
+                        print(name,"difference in distance between Exoplanet and Wikipedia is "+str(distStars)+"-"+str(dist)+" > 100 ly. Keeping Wikipedia datum")
+                        logging.warning(f"difference in distance between Exoplanet and Wikipedia for star {name} is "+str(distStars)+"-"+str(dist)+" > 100 ly. Keeping Wikipedia datum")
                     else:
-                        valsWiki.append(None)
-                #if "HD 219134" in valsWiki[0]:
-                #    print(valsWiki[0])
-                wikiName = valsWiki[0].replace('[[','').replace(']]','').encode("utf-8").decode()  #get star name from wiki page
-                tmpName = wikiName.split("|")
-                name = tmpName[0] # Appearing name, not internal link
-                
-                ref_index = name.find("<ref>")
-                if ref_index != -1: #if the name contains a reference, exclude it
-                    name = name[0:ref_index]
-                    
-                if "<ref>" in lineWikiRaw:
-                    logging.warning(f"A reference is present in {name}. Check that it's correctly reported.")
-                    print("A reference is present in "+name+". Check that it's correctly reported.")
-
-                raWf = valsWiki[1].split("|")
-                ma = int(raWf[2])
-                sa = round(float(raWf[3][:-2]))
-                if(sa == 60):
-                    sa = 0
-                    ma +=1
-                raW = str(int(raWf[1])) +"|"+ str(ma) +"|"+ str(sa)      #get RA from wiki page
-            
-                decWf = valsWiki[2].split("|")
-                md = int(decWf[2])
-                sd = round(float(decWf[3][:-2]))
-                if(sd == 60):
-                    sd = 0
-                    md +=1
-                decW = str(int(decWf[1])) +"|"+ str(md) +"|"+ str(sd)    #get DEC from wiki page
-            
-                # Search coordinates in 'stars' by Simbad(name) (distance ignored 'cause already in 'stars')
-                ra, dec, distSimbad, mag, ids = getCoordFromSimbadLocalTable(name)
-                """if(ra == None): # if not found in Simbad local try again online
-                    distSimbad, ra, dec = getCoordFromSimbadOnline(name)
-                    #print(distSimbad, ra, dec)"""
-
-                if(ra == None): # if not found anyway, use wiki data
-                    ra = raW
-                    dec = decW
-
-                #search by coordinates in 'stars' db
-                sqliteCursor.execute("SELECT name,mag,dist,type,mass,radius,temp,age,metall FROM stars WHERE ra=? AND dec=?",(ra,dec))
-                row = sqliteCursor.fetchone()
-                if(row is None): # or search by name
-                    try:
-                        name2Search = name
-                        if name.startswith("Gliese"):
-                            name2Search = name.replace("Gliese", "GJ", 1)  #Gliese stars appear as GJ in exoplanet.eu
-                        #elif name.endswith(" [A-D]"):
-                        #    name2Search = name.replace(" [A-D]", "", 1)  #
-                        sqliteCursor.execute("SELECT name,mag,dist,type,mass,radius,temp,age,metall FROM stars WHERE name LIKE'"+name2Search+"%'")
-                        row = sqliteCursor.fetchone()
-                    except sl.Error as err:
-                        print(name,err)
-
-                # UPDATE WHERE not empty or not too different
-                if(row is None):  #It's in wiki, not in 'stars' db. Maybe ther is a problem
-                    logging.info(f"Star {name} with coordinates RA:{raW}, DEC:{decW} is in current wiki, but not valid (not existent or less then 2 valid planets)") 
-                    print("Star",name,"with coordinates RA:",raW,"DEC:",decW," is in current wiki, but not valid (not existent or less then 2 valid planets)") 
-                else:
-                    # Use wiki name and data if not null
-                    rowList = list(row)
-
-                    distStars = rowList[2]  #dist in 'stars'
-                    dist = valsWiki[4]      #dist in Wiki
-                    if(distStars != "" and distStars != None and distStars > 0):
-                        if(abs ((float(valsWiki[4]) - float(distStars))) > 1000):  # Too different. Maybe there is a problem
-                            print(name,"difference in distance between Exoplanet and Wikipedia is "+str(distStars)+"-"+str(valsWiki[4])+" > 100 ly. Keeping Wikipedia datum")
-                            logging.warning(f"difference in distance between Exoplanet and Wikipedia for star {name} is "+str(distStars)+"-"+str(valsWiki[4])+" > 100 ly. Keeping Wikipedia datum")
-                        else:
-                            dist = distStars
-               
-                    sqlUpd = "UPDATE stars SET name=?,mag=COALESCE(NULLIF(mag,0),?),dist=COALESCE(NULLIF(dist,0),?),type=COALESCE(NULLIF(type,''),?),mass=COALESCE(NULLIF(mass,0),?),radius=COALESCE(NULLIF(radius,0),?),temp=COALESCE(NULLIF(temp,0),?),age=COALESCE(NULLIF(age,0),?),metall=COALESCE(NULLIF(metall,0),?) WHERE ra=? AND dec=?"   
-                    sqliteCursor.execute(sqlUpd, (wikiName,valsWiki[3],dist,valsWiki[5],valsWiki[6],valsWiki[7],valsWiki[8],valsWiki[9],valsWiki[10],ra,dec) )
+                        dist = distStars
+
+                sqliteCursor.execute(sqlUpd, (record["Stella"],record.get("Magnitudine apparente"),dist,record["Tipo spettrale"],record.get("Massa"),
+                                              record.get("Raggio"),record.get("Temperatura"),record.get("Età"),record.get("Metallicità"),rowid))
 
     sqliteConn.commit()
 
-def generateWikitable(tableOutFile):
-    """ Generate wikitables from on stars.db """
-    
-    logging.debug(f"generateWikitable")
-    
-    tableWiki = open(tableOutFile, 'w', encoding="utf-8")
+class TableRenderer:
+    """Output of renderTables: row() receives the StarSystem of every row of 'stars', in order of name, end() the number
+    of systems by number of planets. number() formats a value with the decimal separator of the output"""
 
-    sqliteCursor.execute("SELECT COUNT(*), planets FROM stars GROUP BY planets ORDER BY planets ASC")
-    rows = sqliteCursor.fetchall()
+    decimal = "."
 
-    p = [0,0,0,0,0,0,0,0,0]
-    for i in range(len(rows)):
-        p[i] = rows[i][0]
+    def __init__(self, path):
+        self.path = path
 
-    line = "{{Progetto sistemi multiplanetari|con2pianeti="+str(p[0])+"|con3pianeti="+str(p[1])+"|con4pianeti="+str(p[2])+"|con5pianeti="+str(p[3])+"|con6pianeti="+str(p[4])+"|con7pianeti="+str(p[5])+"|con8pianeti="+str(p[6])+"}}"
-    tableWiki.write("%s\n" % line)
+    def number(self, val, precision):
+        return wikiRightFormat(val, precision).replace(".", self.decimal)
 
-    tableWiki.write("%s\n" % "")
+    def row(self, star):
+        pass
 
-    line = "<noinclude>{{Stelle con pianeti extrasolari confermati/Top}}</noinclude>"
-    tableWiki.write("%s\n" % line)
+    def end(self, planetCounts):
+        pass
 
-    sqliteCursor.execute("SELECT * FROM stars ORDER BY name ASC")
-    rows = sqliteCursor.fetchall()
-    for row in rows:
-        line = "{{Stelle con pianeti extrasolari confermati"
-        tableWiki.write("%s\n" % line)
-        raIn = row[1].split("|")
-        decIn = row[2].split("|")
-        raOut = raIn[0].zfill(2)+"|"+raIn[1].zfill(2)+"|"+raIn[2].zfill(2)
-        if(int(decIn[0]) < 0):
-            tmp = "-"+str(-int(decIn[0])).zfill(2)
-        else:
-            tmp = decIn[0].zfill(2)
-        decOut = tmp+"|"+decIn[1].zfill(2)+"|"+decIn[2].zfill(2)
+def wikiCoordinates(star):
+    """Return the fields of the templates {{RA}} and {{DEC}} for the coordinates of star: 'hh|mm|ss', '[-]dd|mm|ss'"""
 
-        mag = wikiRightFormat(row[3],2)
-        dist = wikiRightFormat(row[4],-1)
-        tipo = wikiRightFormat(row[5],-1)
-        massa = wikiRightFormat(row[6],2)
-        try:
-            raggio = wikiRightFormat(row[7],2)
-        except:
-            print(row[0])
-        temper = wikiRightFormat(row[8],0)
-        eta = wikiRightFormat(row[9],-1)
-        metall = wikiRightFormat(row[10],2)
-
-        ref_index = row[0].find("<ref>")
-        if ref_index != -1: #if the name contains a reference put it outside [[name]]
-            name = "[["+row[0][0:ref_index]+"]]"+row[0][ref_index:]
-        else:
-            name = "[["+row[0]+"]]"
-        tmp = "|Stella="+name+"||Ascensione retta={{RA|"+raOut+"}}||Declinazione={{DEC|"+decOut+"}}||Magnitudine apparente="+mag+"||Distanza="+dist+"||Tipo spettrale="+tipo+"||Massa="+massa+"||Raggio="+raggio+"||Temperatura="+temper+"||Età="+eta+"||Metallicità="+metall+"||Pianeti="+str(row[11])+"}}"
-      
-        tableWiki.write("%s\n" % tmp.replace('.',','))
+    raIn = star.ra.split("|")
+    decIn = star.dec.split("|")
+    raOut = raIn[0].zfill(2)+"|"+raIn[1].zfill(2)+"|"+raIn[2].zfill(2)
+    if(int(decIn[0]) < 0):
+        tmp = "-"+str(-int(decIn[0])).zfill(2)
+    else:
+        tmp = decIn[0].zfill(2)
+    return raOut, tmp+"|"+decIn[1].zfill(2)+"|"+decIn[2].zfill(2)
+
+def wikiLink(name):
+    """Return name as a wiki link, with its reference (if any) outside the link"""
+
+    ref_index = name.find("<ref>")
+    if ref_index != -1:
+        return "[["+name[0:ref_index]+"]]"+name[ref_index:]
+    return "[["+name+"]]"
+
+class ItWikiRenderer(TableRenderer):
+    """Table of https://it.wikipedia.org/wiki/Sistemi_multiplanetari, a template {{Stelle con pianeti extrasolari confermati}} for every star"""
+
+    decimal = ","
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.lines = []  # the count of the systems goes before them
+
+    def row(self, star):
+        raOut, decOut = wikiCoordinates(star)
+        fields = [("Stella", wikiLink(star.name)),
+                  ("Ascensione retta", "{{RA|"+raOut+"}}"),
+                  ("Declinazione", "{{DEC|"+decOut+"}}"),
+                  ("Magnitudine apparente", self.number(star.mag, 2)),
+                  ("Distanza", self.number(star.dist, -1)),
+                  ("Tipo spettrale", self.number(star.type, -1)),
+                  ("Massa", self.number(star.mass, 2)),
+                  ("Raggio", self.number(star.radius, 2)),
+                  ("Temperatura", self.number(star.temp, 0)),
+                  ("Età", self.number(star.age, -1)),
+                  ("Metallicità", self.number(star.metall, 2)),
+                  ("Pianeti", str(star.planets))]
+        self.lines.append("{{Stelle con pianeti extrasolari confermati")
+        self.lines.append("|" + "||".join(parameter+"="+value for parameter, value in fields) + "}}")
+
+    def end(self, planetCounts):
+        with open(self.path, 'w', encoding="utf-8") as tableWiki:
+            tableWiki.write("{{Progetto sistemi multiplanetari|" + "|".join("con"+str(n)+"pianeti="+str(planetCounts.get(n, 0)) for n in range(2, 9)) + "}}\n")
+            tableWiki.write("\n")
+            tableWiki.write("<noinclude>{{Stelle con pianeti extrasolari confermati/Top}}</noinclude>\n")
+            for line in self.lines:
+                tableWiki.write("%s\n" % line)
+            tableWiki.write("<noinclude>{{Stelle con pianeti extrasolari confermati/Bottom}}</noinclude>\n")
+
+wikitableLanguages = {  # decimal separator and column titles of WikitableRenderer
+        "en": (".", ["Star", "Right ascension", "Declination", "Apparent magnitude", "Distance (ly)", "Spectral type", "Mass (M☉)",
+                     "Radius (R☉)", "Temperature (K)", "Age (Gyr)", "Metallicity [Fe/H]", "Planets"]),
+        "it": (",", ["Stella", "Ascensione retta", "Declinazione", "Magnitudine apparente", "Distanza (al)", "Tipo spettrale", "Massa (M☉)",
+                     "Raggio (R☉)", "Temperatura (K)", "Età (Ga)", "Metallicità [Fe/H]", "Pianeti"])
+}
 
-    line = "<noinclude>{{Stelle con pianeti extrasolari confermati/Bottom}}</noinclude>"
-    tableWiki.write("%s\n" % line)
+class WikitableRenderer(TableRenderer):
+    """Plain sortable wikitable, with the column titles and the decimal separator of language (see wikitableLanguages)"""
+
+    def __init__(self, path, language="en"):
+        super().__init__(path)
+        self.decimal, titles = wikitableLanguages[language]
+        self.file = open(path, 'w', encoding="utf-8")
+        self.file.write('{| class="wikitable sortable"\n! ' + " !! ".join(titles) + "\n")
+
+    def row(self, star):
+        raOut, decOut = wikiCoordinates(star)
+        fields = [wikiLink(star.name), "{{RA|"+raOut+"}}", "{{DEC|"+decOut+"}}", self.number(star.mag, 2), self.number(star.dist, -1),
+                  self.number(star.type, -1), self.number(star.mass, 2), self.number(star.radius, 2), self.number(star.temp, 0),
+                  self.number(star.age, -1), self.number(star.metall, 2), str(star.planets)]
+        self.file.write("|-\n| " + " || ".join(fields) + "\n")
+
+    def end(self, planetCounts):
+        self.file.write("|}\n")
+        self.file.close()
+
+class CsvRenderer(TableRenderer):
+    """The StarSystem.tableFields of 'stars' in a csv file, values as stored"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = open(path, 'w', encoding="utf-8", newline='')
+        self.writer = csv.writer(self.file)
+        self.header = False
+
+    def row(self, star):
+        if not self.header:
+            self.writer.writerow(StarSystem.tableFields)
+            self.header = True
+        self.writer.writerow(star.row()[:len(StarSystem.tableFields)])
+
+    def end(self, planetCounts):
+        self.file.close()
+
+class JsonRenderer(TableRenderer):
+    """The StarSystem.tableFields of 'stars' in a JSON array of objects, values as stored"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = open(path, 'w', encoding="utf-8")
+        self.separator = "[\n"
+
+    def row(self, star):
+        self.file.write(self.separator + json.dumps(star.asDict(), ensure_ascii=False))
+        self.separator = ",\n"
+
+    def end(self, planetCounts):
+        self.file.write("[]\n" if self.separator == "[\n" else "\n]\n")
+        self.file.close()
+
+tableRenderers = {  # formats of renderTargets
+        "itwiki": ItWikiRenderer,
+        "wikitable-en": lambda path: WikitableRenderer(path, "en"),
+        "wikitable-it": lambda path: WikitableRenderer(path, "it"),
+        "csv": CsvRenderer,
+        "json": JsonRenderer
+}
+renderTargets = []  # (format, path) written by the render stage together with tableOutFile
 
-    sqliteConn.close()
+def renderTables(renderers):
+    """ Write the outputs of renderers (TableRenderer) with one pass over the rows of 'stars' """
 
-def main():
+    logging.debug(f"renderTables")
 
-    warnings.simplefilter('ignore', UserWarning)
+    planetCounts = {}
+    for star in selectStars("ORDER BY name ASC"):
+        planetCounts[star.planets] = planetCounts.get(star.planets, 0) + 1
+        for renderer in renderers:
+            renderer.row(star)
+    for renderer in renderers:
+        renderer.end(planetCounts)
+
+def generateWikitable(tableOutFile, targets=()):
+    """ Generate wikitables from on stars.db: the table of it.wikipedia in tableOutFile and the (format, path) of targets """
     
-    # Set up logging configuration
-    logging.basicConfig(
-        level=logging.INFO,  # Set the minimum log level to DEBUG
-        format='%(asctime)s - %(levelname)s - %(message)s',  # Log format
-        handlers=[
-            logging.StreamHandler(),  # Log to the console
-            logging.FileHandler('multiplanetaryListUpdBot.log', mode='a')  # Log to a file (append mode)
-            ]
-        )
-    warnings.filterwarnings('ignore', category=AstropyWarning)
+    logging.debug(f"generateWikitable")
+
+    renderTables([ItWikiRenderer(tableOutFile)] + [tableRenderers[kind](path) for kind, path in targets])
+
+columnarTables = {  # columns of the columnar snapshot written by exportColumnar: name -> "float" (float64, NaN if empty) or "str"
+        "stars": {"name": "str", "ra": "str", "dec": "str", "raDeg": "float", "decDeg": "float", "mag": "float", "dist": "float",
+                  "type": "str", "mass": "float", "radius": "float", "temp": "float", "age": "float", "metall": "float",
+                  "planets": "float", "altNames": "str"},
+        "simbad": {"name": "str", "ra": "str", "dec": "str", "raDeg": "float", "decDeg": "float", "mag": "float", "dist": "float", "ids": "str"}
+}
+
+def columnarFloat(value):
+    try:
+        return float(value) if value not in (None, '') else math.nan
+    except ValueError:  # text in a numeric column
+        return math.nan
+
+def exportColumnar(directory):
+    """Write the tables of columnarTables in directory: <table>/<column>.npy for the numeric columns, <table>/<column>.bytes.npy
+    (UTF-8 of all the values) and <table>/<column>.offsets.npy for the strings, manifest.json. The old snapshot is replaced at the end"""
+
+    logging.info(f"exportColumnar: {directory}")
+
+    tmpDir = directory.rstrip("/\\") + ".part"
+    if os.path.exists(tmpDir):
+        shutil.rmtree(tmpDir)
+    manifest = {"created": time.time(), "tables": {}}
+    for table, columns in columnarTables.items():
+        os.makedirs(os.path.join(tmpDir, table))
+        sqliteCursor.execute("SELECT " + ",".join(columns) + " FROM " + table + " ORDER BY " + ("name" if table == "stars" else "rowid"))
+        rows = sqliteCursor.fetchall()
+        for i, (column, kind) in enumerate(columns.items()):
+            path = os.path.join(tmpDir, table, column)
+            if kind == "float":
+                np.save(path + ".npy", np.array([columnarFloat(row[i]) for row in rows], dtype=np.float64))
+            else:
+                encoded = [(row[i] or "").encode("utf-8") for row in rows]
+                np.save(path + ".offsets.npy", np.concatenate(([0], np.cumsum([len(value) for value in encoded], dtype=np.int64))).astype(np.int64))
+                np.save(path + ".bytes.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        manifest["tables"][table] = {"rows": len(rows), "columns": columns}
+    with open(os.path.join(tmpDir, "manifest.json"), "w", encoding="utf-8") as manifestFile:
+        json.dump(manifest, manifestFile, indent=2)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(tmpDir, directory)
+    return directory
+
+class StringColumn:
+    """String column of a columnar snapshot, decoded one value at a time from the memory-mapped bytes"""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+def loadColumnar(directory):
+    """Open the snapshot written by exportColumnar without copying it: return {table: {column: memory-mapped float64 array or StringColumn}}"""
+
+    with open(os.path.join(directory, "manifest.json"), encoding="utf-8") as manifestFile:
+        manifest = json.load(manifestFile)
+    tables = {}
+    for table, description in manifest["tables"].items():
+        tables[table] = {}
+        for column, kind in description["columns"].items():
+            path = os.path.join(directory, table, column)
+            if kind == "float":
+                tables[table][column] = np.load(path + ".npy", mmap_mode="r")
+            else:
+                tables[table][column] = StringColumn(np.load(path + ".bytes.npy", mmap_mode="r"), np.load(path + ".offsets.npy", mmap_mode="r"))
+    return tables
+
+def createHistoryTables():
+    with sqliteConn:  # kept between runs: the run history, see recordRun and diffRuns
+        sqliteConn.execute("""
+         CREATE TABLE IF NOT EXISTS runs (
+         run INTEGER PRIMARY KEY,
+         finished REAL,
+         stars INTEGER
+        );
+      """)
+        sqliteConn.execute("""
+         CREATE TABLE IF NOT EXISTS run_stars (
+         run INTEGER,
+         key TEXT,
+         hash TEXT,
+         planets INTEGER,
+         fields TEXT,
+         PRIMARY KEY (run, key)
+        ) WITHOUT ROWID;
+      """)
+
+def recordRun():
+    """Add 'stars' to the run history: for every star, keyed by normalizeId(name), a hash of its historyFields, the number
+    of planets and the fields as JSON (to report which ones changed). Keep the last historyRuns runs, return the new run"""
+
+    createHistoryTables()
+    sqliteCursor.execute("INSERT INTO runs (finished,stars) VALUES(?,0);", (time.time(),))
+    run = sqliteCursor.lastrowid
+    historyBuffer = WriteBuffer("INSERT OR REPLACE INTO run_stars (run,key,hash,planets,fields) VALUES(?,?,?,?,?);")
+    planetsIndex = historyFields.index("planets")
+    for row in sqliteConn.execute("SELECT " + ",".join(historyFields) + " FROM stars"):
+        fields = json.dumps(row, ensure_ascii=False, separators=(",", ":"))
+        historyBuffer.add((run, normalizeId(row[0]), hashlib.blake2b(fields.encode("utf-8"), digest_size=8).hexdigest(), row[planetsIndex], fields))
+    historyBuffer.flush()
+    sqliteCursor.execute("UPDATE runs SET stars=(SELECT count(*) FROM run_stars WHERE run=?) WHERE run=?", (run, run))
+    sqliteCursor.execute("DELETE FROM run_stars WHERE run<=?", (run - historyRuns,))
+    sqliteCursor.execute("DELETE FROM runs WHERE run<=?", (run - historyRuns,))
+    sqliteConn.commit()
+    logging.info(f"Run {run} saved in the history")
+    return run
+
+def diffRuns(old=None, new=None):
+    """Compare two runs of the history (default: the last two) in one pass over both, ordered by key.
+    Return {"old", "new", "added": [(name, planets)], "removed": [(name, planets)], "changed": [(name, {field: (old, new)})],
+    "planets": [(name, old planets, new planets)]}: the number of planets is reported only in "planets" """
+
+    createHistoryTables()
+    sqliteCursor.execute("SELECT run FROM runs ORDER BY run DESC")
+    runs = [run for run, in sqliteCursor.fetchall()]
+    if new is None:
+        new = runs[0] if runs else None
+    if old is None:
+        old = next((run for run in runs if new is not None and run < new), None)
+    if old not in runs or new not in runs:
+        raise ValueError(f"Runs to compare not in the history: {old}, {new} (runs: {sorted(runs)})")
+
+    query = "SELECT key,hash,planets,fields FROM run_stars WHERE run=? ORDER BY key"
+    oldRows = sqliteConn.execute(query, (old,))
+    newRows = sqliteConn.execute(query, (new,))
+    diff = {"old": old, "new": new, "added": [], "removed": [], "changed": [], "planets": []}
+    oldRow = next(oldRows, None)
+    newRow = next(newRows, None)
+    while oldRow is not None or newRow is not None:
+        if newRow is None or (oldRow is not None and oldRow[0] < newRow[0]):
+            diff["removed"].append((json.loads(oldRow[3])[0], oldRow[2]))
+            oldRow = next(oldRows, None)
+        elif oldRow is None or newRow[0] < oldRow[0]:
+            diff["added"].append((json.loads(newRow[3])[0], newRow[2]))
+            newRow = next(newRows, None)
+        else:
+            if oldRow[1] != newRow[1]:  # same hash: same fields, nothing to decode
+                oldFields = json.loads(oldRow[3])
+                newFields = json.loads(newRow[3])
+                if oldRow[2] != newRow[2]:
+                    diff["planets"].append((newFields[0], oldRow[2], newRow[2]))
+                changed = {field: (a, b) for field, a, b in zip(historyFields, oldFields, newFields) if a != b and field != "planets"}
+                if changed:
+                    diff["changed"].append((newFields[0], changed))
+            oldRow = next(oldRows, None)
+            newRow = next(newRows, None)
+    return diff
+
+def formatDiff(diff):
+    """Return the report of diffRuns as text, one line per system"""
+
+    lines = [f"Run {diff['old']} -> run {diff['new']}: {len(diff['added'])} added, {len(diff['removed'])} removed, "
+             f"{len(diff['changed'])} changed, {len(diff['planets'])} with a different number of planets"]
+    lines += [f"+ {name} ({planets} planets)" for name, planets in diff["added"]]
+    lines += [f"- {name} ({planets} planets)" for name, planets in diff["removed"]]
+    lines += [f"# {name}: planets {a} -> {b}" for name, a, b in diff["planets"]]
+    lines += [f"~ {name}: " + "; ".join(f"{field} {a} -> {b}" for field, (a, b) in fields.items()) for name, fields in diff["changed"]]
+    return "\n".join(lines)
+
+def createTables():
+    """ (Re)create the tables of stars.db used by the program """
+
+    global nameResolverShared
+    nameResolverShared = None
+
+    sqliteCursor.execute("DROP TABLE IF EXISTS stars_resolved")  # see saveResolvedStars
+    sqliteCursor.execute("DROP TABLE IF EXISTS stars_nasa")
     sqliteCursor.execute("DROP TABLE IF EXISTS stars")
     with sqliteConn:
         sqliteConn.execute("""
@@ -630,9 +1968,12 @@ def main():
           age REAL DEFAULT 0.0,
           metall REAL DEFAULT 0.0,
           planets INTEGER,
-          altNames TEXT
+          altNames TEXT,
+          raDeg REAL,
+          decDeg REAL
         );
       """)
+        sqliteConn.execute("CREATE INDEX stars_name ON stars(name)")  # lookups and updates by name
 
     sqliteCursor.execute("DROP TABLE IF EXISTS simbad")
     with sqliteConn:
@@ -644,27 +1985,369 @@ def main():
          mag REAL,
          dist REAL,
          ids TEXT,
+         raDeg REAL,
+         decDeg REAL,
          PRIMARY KEY (ra, dec)
         );
       """)
+
+    for table in ("stars", "simbad"):  # R*Tree of raDeg, decDeg for nearestCoords(), kept updated by triggers
+        sqliteCursor.execute(f"DROP TABLE IF EXISTS {table}_coords")
+        with sqliteConn:
+            sqliteConn.execute(f"CREATE VIRTUAL TABLE {table}_coords USING rtree(id, minRa, maxRa, minDec, maxDec)")
+            sqliteConn.execute(f"""
+             CREATE TRIGGER {table}_coords_insert AFTER INSERT ON {table} WHEN new.raDeg IS NOT NULL BEGIN
+               INSERT INTO {table}_coords VALUES (new.rowid, new.raDeg, new.raDeg, new.decDeg, new.decDeg);
+             END;
+          """)
+            sqliteConn.execute(f"""
+             CREATE TRIGGER {table}_coords_update AFTER UPDATE OF raDeg, decDeg ON {table} WHEN new.raDeg IS NOT NULL BEGIN
+               INSERT OR REPLACE INTO {table}_coords VALUES (new.rowid, new.raDeg, new.raDeg, new.decDeg, new.decDeg);
+             END;
+          """)
+            sqliteConn.execute(f"""
+             CREATE TRIGGER {table}_coords_delete AFTER DELETE ON {table} BEGIN
+               DELETE FROM {table}_coords WHERE id = old.rowid;
+             END;
+          """)
+
+    sqliteCursor.execute("DROP TABLE IF EXISTS simbad_ids")
+    with sqliteConn:  # one row per identifier of every 'simbad' row, normalized by normalizeId()
+        sqliteConn.execute("""
+         CREATE TABLE simbad_ids (
+         id TEXT,
+         ra TEXT,
+         dec TEXT,
+         PRIMARY KEY (id, ra, dec)
+        ) WITHOUT ROWID;
+      """)
+
+    sqliteCursor.execute("PRAGMA table_info(simbad_cache)")
+    columns = [column[1] for column in sqliteCursor.fetchall()]
+    if columns and "method" not in columns:  # cache of a previous version, answers of the two methods mixed: asked again
+        with sqliteConn:
+            sqliteConn.execute("DROP TABLE simbad_cache")
+    with sqliteConn:  # kept between runs: answers of Simbad for every name asked, see simbadCacheTTL
+        sqliteConn.execute("""
+         CREATE TABLE IF NOT EXISTS simbad_cache (
+         query TEXT,
+         method TEXT,
+         name TEXT,
+         ra TEXT,
+         dec TEXT,
+         mag REAL,
+         dist REAL,
+         ids TEXT,
+         raDeg REAL,
+         decDeg REAL,
+         fetched REAL,
+         PRIMARY KEY (query, method)
+        ) WITHOUT ROWID;
+      """)
+    createCheckpointsTable()
+    createHistoryTables()
+
+pipelineStages = [  # (stage, stages it needs, function of their results) in order of execution. Stages "fetch*" only download and run in parallel threads
+        ("fetchExoplanet", [], lambda results: fetchSource("exoplanet")[0]),
+        ("fetchNASA", [], lambda results: fetchSource("nasa")[0]),
+        ("fetchWikipedia", [], lambda results: fetchSource("wikipedia")[0]),
+        ("exoplanet", ["fetchExoplanet"], lambda results: getDataFromExoplanet(results["fetchExoplanet"])),
+        ("simbad", ["exoplanet"], lambda results: getDataFromSimbadSite()),
+        ("nasa", ["simbad", "fetchNASA"], lambda results: getDataFromNASA(results["fetchNASA"])),
+        ("wikipedia", ["nasa", "fetchWikipedia"], lambda results: getDataFromWikipedia(results["fetchWikipedia"])),
+        ("history", ["wikipedia"], lambda results: recordRun()),
+        ("render", ["wikipedia"], lambda results: generateWikitable(tableOutFile, renderTargets)),
+        ("export", ["wikipedia"], lambda results: exportColumnar(columnarDir) if columnarDir else None)
+]
+commandStages = {  # stages run by every command of the command line, the others are taken from stars.db
+        "fetch": ["fetchExoplanet", "fetchNASA", "fetchWikipedia"],
+        "resolve": ["fetchExoplanet", "exoplanet", "simbad"],
+        "merge": ["fetchExoplanet", "fetchNASA", "fetchWikipedia", "exoplanet", "simbad", "nasa", "wikipedia", "history"],
+        "render": ["render"],
+        "export": ["export"],
+        "all": None
+}
+pipelineResets = {  # statements undoing the rows committed by a stage that failed halfway, run before it's run again
+        "exoplanet": ["DELETE FROM stars"],
+        "simbad": ["DELETE FROM simbad", "DELETE FROM simbad_ids"]
+}
+
+def selectStages(stages, names):
+    """Return the stages named in names (all if None), without the needs on the other stages (already done in stars.db)"""
+
+    if names is None:
+        return stages
+    return [(stage, [need for need in needs if need in names], function) for stage, needs, function in stages if stage in names]
+
+def createCheckpointsTable():
+    with sqliteConn:  # kept between runs: stages completed by the last run, see runPipeline
+        sqliteConn.execute("""
+         CREATE TABLE IF NOT EXISTS pipeline_checkpoints (
+         stage TEXT PRIMARY KEY,
+         result TEXT,
+         finished REAL
+        );
+      """)
+
+def getCheckpoints():
+    """Return {stage: result} of the stages completed by the last run"""
+
+    sqliteCursor.execute("SELECT stage, result FROM pipeline_checkpoints")
+    return {stage: json.loads(result) for stage, result in sqliteCursor.fetchall()}
+
+def putCheckpoint(stage, result):
+    """Save in 'pipeline_checkpoints' that stage is completed, together with the changes of the stage"""
+
+    sqliteCursor.execute("INSERT OR REPLACE INTO pipeline_checkpoints (stage,result,finished) VALUES(?,?,?);", (stage, json.dumps(result), time.time()))
+    sqliteConn.commit()
+
+def runPipeline(stages, resume=False, create=True):
+    """Run stages (see pipelineStages): the fetch stages at once in threads, the others in order in the main thread, each as soon
+    as the stages it needs are completed. Every completed stage is checkpointed in stars.db until the last one: with resume, the
+    stages completed by a previous failed run are skipped and their results reused. With create False the tables of stars.db are kept"""
+
+    checkpoints = {}
+    if resume:
+        try:
+            checkpoints = getCheckpoints()
+        except sl.Error:  # stars.db of a previous version
+            pass
+    if checkpoints:
+        logging.info(f"runPipeline: resuming after stages {list(checkpoints)}")
+    elif not create:
+        createCheckpointsTable()
+    else:
+        createTables()
+        sqliteCursor.execute("DELETE FROM pipeline_checkpoints")
+        sqliteConn.commit()
+
+    results = dict(checkpoints)
+    done = [stage for stage, _, _ in stages if stage in checkpoints]
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        fetches = {stage: executor.submit(function, results) for stage, _, function in stages
+                   if stage.startswith("fetch") and stage not in checkpoints}
+        for stage, needs, function in stages:
+            if stage in done or stage in fetches:
+                continue
+            for need in needs:
+                if need not in done:
+                    if need not in fetches:
+                        raise ValueError(f"Stage {stage} needs {need}, which is not completed before it")
+                    results[need] = fetches[need].result()
+                    putCheckpoint(need, results[need])
+                    done.append(need)
+
+            print("Running stage "+stage+" ...")
+            logging.info(f"runPipeline: stage {stage}")
+            for statement in pipelineResets.get(stage, []):
+                sqliteCursor.execute(statement)
+            try:
+                results[stage] = function(results)
+            except Exception:
+                sqliteConn.rollback()
+                logging.exception(f"runPipeline: stage {stage} failed. Run again with --resume to restart from it")
+                raise
+            putCheckpoint(stage, results[stage])
+            done.append(stage)
+        for stage, future in fetches.items():  # downloads not needed by the stages run
+            if stage not in done:
+                results[stage] = future.result()
+                putCheckpoint(stage, results[stage])
+    sqliteCursor.execute("DELETE FROM pipeline_checkpoints")  # completed: nothing to resume
+    sqliteConn.commit()
+    return results
+
+def saveResolvedStars(table="stars_resolved"):
+    """Copy 'stars' in table: 'stars_resolved' after the Simbad stage, watch restarts from it when only NASA or Wikipedia changed,
+    'stars_nasa' after the NASA stage, watch restarts from it when only Wikipedia changed"""
+
+    sqliteCursor.execute("DROP TABLE IF EXISTS " + table)
+    sqliteCursor.execute("CREATE TABLE " + table + " AS SELECT rowid AS id," + ",".join(StarSystem.__slots__) + " FROM stars")
+    sqliteConn.commit()
+
+def restoreResolvedStars(table="stars_resolved"):
+    """Put back in 'stars' the rows saved in table by saveResolvedStars, with the same rowids"""
+
+    global nameResolverShared
+    columns = ",".join(StarSystem.__slots__)
+    sqliteCursor.execute("DELETE FROM stars")
+    sqliteCursor.execute("INSERT INTO stars (rowid," + columns + ") SELECT id," + columns + " FROM " + table)
+    sqliteConn.commit()
+    nameResolverShared = None  # names changed by the Wikipedia stage
+
+def starsDigest():
+    """Return a hash of the StarSystem.tableFields of all the rows of 'stars', in order of name"""
+
+    digest = hashlib.sha1()
+    for star in selectStars("ORDER BY name ASC"):
+        digest.update(json.dumps(star.row()[:len(StarSystem.tableFields)], ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+def watch(cycles=None):
+    """Keep running with the same connection, HTTP session and Simbad data: poll every source every watchIntervals[source]
+    seconds (conditional requests, see fetchSource) and re-run only the merge stages after the first changed source:
+    exoplanet.eu rebuilds 'stars' (Simbad answers from 'simbad_cache'), NASA restarts from 'stars_resolved', Wikipedia from 'stars_nasa'.
+    The history and the outputs are written only if 'stars' changed, also since the 'stars' left by the previous run.
+    A failed update keeps the previous outputs and is tried again at the next poll. cycles limits the number of polls (None: forever)"""
+
+    snapshots = {}
+    due = {source: 0 for source in watchIntervals}
+    sqliteCursor.execute("SELECT count(*) FROM stars")
+    lastDigest = starsDigest() if sqliteCursor.fetchone()[0] > 0 else None  # a restart doesn't rewrite the same outputs
+    pending = set()  # changed sources not yet in the outputs
+    cycle = 0
+    while cycles is None or cycle < cycles:
+        changed = set()
+        for source in watchIntervals:
+            if due[source] > time.time():
+                continue
+            due[source] = time.time() + watchIntervals[source]
+            try:
+                snapshots[source], sourceChanged = fetchSource(source)
+            except (Exception, SystemExit) as err:  # fetchSource exits on a failed download: try again at the next poll
+                logging.warning(f"watch: fetch of {source} failed: {err!r}")
+                continue
+            if sourceChanged:
+                changed.add(source)
+        cycle += 1
+        pending |= changed
+
+        sqliteCursor.execute("SELECT name FROM sqlite_master WHERE name IN ('stars_resolved','stars_nasa')")
+        saved = {row[0] for row in sqliteCursor.fetchall()}
+        if len(snapshots) < len(watchIntervals) or not (pending or "stars_resolved" not in saved):
+            logging.info(f"watch: nothing to do")
+        else:
+            logging.info(f"watch: changed {sorted(pending)}")
+            resolve = "exoplanet" in pending or "stars_resolved" not in saved
+            nasa = resolve or "nasa" in pending or "stars_nasa" not in saved
+            try:
+                if resolve:
+                    createTables()
+                    getDataFromExoplanet(snapshots["exoplanet"])
+                    getDataFromSimbadSite()
+                    saveResolvedStars()
+                elif nasa:
+                    restoreResolvedStars()
+                else:
+                    restoreResolvedStars("stars_nasa")
+                if nasa:
+                    getDataFromNASA(snapshots["nasa"])
+                    saveResolvedStars("stars_nasa")
+                getDataFromWikipedia(snapshots["wikipedia"])
+
+                digest = starsDigest()
+                if digest != lastDigest:
+                    recordRun()
+                    generateWikitable(tableOutFile, renderTargets)
+                    if columnarDir:
+                        exportColumnar(columnarDir)
+                    if publishPath:
+                        publishDB(publishPath)
+                    lastDigest = digest
+                    print("Table '"+tableOutFile+"' updated")
+                else:
+                    logging.info(f"watch: 'stars' unchanged, outputs not written")
+                pending = set()
+            except (Exception, SystemExit) as err:  # the stages exit on a malformed or missing file: try again at the next poll
+                sqliteConn.rollback()
+                logging.error(f"watch: update failed, previous outputs kept: {err!r}")
+            if metricsEnabled:
+                writeMetrics()
+
+        if cycles is None or cycle < cycles:
+            time.sleep(max(0, min(due.values()) - time.time()))
+
+def main(argv=None):
+
+    global tableOutFile, offlineMode, renderTargets, columnarDir, parseWorkers, cassetteMode, cassetteDir, simbadResolver
+    parser = argparse.ArgumentParser(description="Update the table of https://it.wikipedia.org/wiki/Sistemi_multiplanetari")
+    parser.add_argument("command", nargs="?", default="all", choices=list(commandStages) + ["diff", "watch"],
+                        help="fetch: download the sources; resolve: load exoplanet.eu and resolve the stars with Simbad; "
+                             "merge: also add NASA and Wikipedia data; render: write the table from stars.db; "
+                             "export: write the columnar snapshot from stars.db; all (default): everything; "
+                             "diff: compare two runs of the history of stars.db; watch: keep running, updating the outputs when a source changes")
+    parser.add_argument("--db", default=dbPath, help="path of the database (default %(default)s)")
+    parser.add_argument("--out", default=tableOutFile, help="file of the table (default %(default)s)")
+    parser.add_argument("--export", action="append", default=[], metavar="FORMAT=PATH",
+                        help="write also the table in PATH, FORMAT one of " + ", ".join(name for name in tableRenderers if name != "itwiki"))
+    parser.add_argument("--columnar", default=columnarDir, metavar="DIR", help="write also a columnar snapshot of 'stars' and 'simbad' (numpy .npy) in DIR")
+    parser.add_argument("--workers", type=int, default=parseWorkers, help="processes parsing the exoplanet.eu catalog (default %(default)s)")
+    parser.add_argument("--runs", type=int, nargs=2, default=[None, None], metavar=("OLD", "NEW"), help="runs compared by diff (default the last two)")
+    parser.add_argument("--memory", action="store_true", help="build in memory and replace --db with the result at the end, never leaving a partial build (a failed one is saved in --db.resume for --resume)")
+    parser.add_argument("--seed", action="store_true", help="with --memory, start from a copy of --db (incremental runs; implied by render and export)")
+    parser.add_argument("--resume", action="store_true", default=resumePipeline, help="skip the stages completed by the previous run")
+    parser.add_argument("--offline", action="store_true", default=offlineMode, help="use the last snapshot of every source, without downloading")
+    parser.add_argument("--tap", action="store_true", default=simbadResolver == "tap", help="resolve all the names with one query to the TAP service of Simbad")
+    cassettes = parser.add_mutually_exclusive_group()
+    cassettes.add_argument("--record", metavar="DIR", help="save every Simbad answer and download in DIR")
+    cassettes.add_argument("--replay", metavar="DIR", help="take every Simbad answer and download from DIR, recorded with --record, without network")
+    parser.add_argument("--metrics", action="store_true", default=collectMetrics, help="save metrics of the run in "+metricsJsonFile+" and "+metricsPromFile)
+    args = parser.parse_args(argv)
+    tableOutFile = args.out
+    columnarDir = args.columnar
+    parseWorkers = args.workers
+    renderTargets = renderTargets + [tuple(target.split("=", 1)) for target in args.export]
+    for kind, *path in renderTargets:
+        if kind not in tableRenderers or not path:
+            parser.error("--export "+kind+": FORMAT=PATH with FORMAT one of " + ", ".join(tableRenderers))
+    offlineMode = args.offline
+    simbadResolver = "tap" if args.tap else "query_objects"
+    if args.record or args.replay:
+        cassetteMode = "record" if args.record else "replay"
+        cassetteDir = args.record or args.replay
+
+    warnings.simplefilter('ignore', UserWarning)
+    
+    # Set up logging configuration
+    logging.basicConfig(
+        level=logging.INFO,  # Set the minimum log level to DEBUG
+        format='%(asctime)s - %(levelname)s - %(message)s',  # Log format
+        handlers=[
+            logging.StreamHandler(),  # Log to the console
+            logging.FileHandler('multiplanetaryListUpdBot.log', mode='a')  # Log to a file (append mode)
+            ]
+        )
+    if args.command == "diff":
+        connectDB(args.db)
+        try:
+            print(formatDiff(diffRuns(*args.runs)))
+        except ValueError as error:
+            print(error)
+            exit()
+        sqliteConn.close()
+        return
+    stages = selectStages(pipelineStages, commandStages[args.command]) if args.command != "watch" else []
+    create = any(stage == "exoplanet" for stage, _, _ in stages)
+    if args.memory:
+        openBuildDB(args.db, seed=args.seed or args.resume or (args.command != "watch" and not create), resume=args.resume)
+    else:
+        connectDB(args.db)
+    if args.metrics:
+        enableMetrics()
+    configureBuildDB()
+    if args.command == "watch":
+        try:
+            watch()
+        except KeyboardInterrupt:
+            pass
+        sqliteConn.close()
+        return
    
-    print("Retrieving data from Exoplanet ...")
-    getDataFromExoplanet(None)    
-    #getDataFromExoplanet("exoplanet.csv")
-    print("Retrieving data from Simbad ...")
-    getDataFromSimbadSite()
-    #print("Retrieving data from NASA ...")
-    #getDataFromNASA(None)                     
-    #getDataFromNASA("NASA.out")
-    print("Retrieving data from Wikipedia ...")
-    getDataFromWikipedia(None)
-    #getDataFromWikipedia("wiki.out")
-    print("Generating 'tabella.wiki' ...")
-    generateWikitable("tabella.wiki")
+    try:
+        runPipeline(stages, args.resume, create)
+    except (Exception, SystemExit, KeyboardInterrupt):
+        if publishPath:  # the build in memory would be lost with its checkpoints
+            saveResumeDB(publishPath)
+        raise
+    if publishPath:
+        publishDB(publishPath)
+    sqliteConn.close()
+    if metricsEnabled:
+        writeMetrics()
     print("Done.")
-    print("Copy the content of the file 'tabella.wiki' in the correct place inside https://it.wikipedia.org/wiki/Sistemi_multiplanetari. Check the result before publishing!")
+    if any(stage == "render" for stage, _, _ in stages):
+        print("Copy the content of the file '"+tableOutFile+"' in the correct place inside https://it.wikipedia.org/wiki/Sistemi_multiplanetari. Check the result before publishing!")
 
 
 if __name__ == "__main__":
     main()
-
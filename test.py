@@ -1,11 +1,35 @@
 import unittest
+import os
+import sys
+import subprocess
+import io
+import math
+import json
+import sqlite3 as sl
+import random
+import tempfile
+import shutil
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy
+from astropy.table import Table, MaskedColumn
+from astropy.io import votable
 
 import multiplanetaryListUpdBot as multiplanetaryListUpdBot
 
 class mainCheck(unittest.TestCase):
 
     def setUp(self):
-        pass
+        multiplanetaryListUpdBot.sqliteConn = sl.connect(":memory:")
+        multiplanetaryListUpdBot.sqliteCursor = multiplanetaryListUpdBot.sqliteConn.cursor()
+        multiplanetaryListUpdBot.createTables()
+
+    def temporaryDirectory(self):
+        """Return a new temporary directory, removed with its content at the end of the test"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        return directory
 
     def test_deg_to_hms(self):
 
@@ -15,17 +39,719 @@ class mainCheck(unittest.TestCase):
         self.assertTrue(ra == "10|56|29",ra)
         self.assertTrue(dec == "7|0|52",dec)
 
+    def test_deg_to_hms_array(self):
+
+        random.seed(1)
+        grads = [164.120833343, 7.014444456, -0.5, 359.99999, -89.9999, 0.0] + [random.uniform(-90, 360) for i in range(5000)]
+        for cooType in ("RA", "DEC"):
+            expected = [multiplanetaryListUpdBot.deg_to_hms(grad, cooType) for grad in grads]
+            self.assertTrue(multiplanetaryListUpdBot.deg_to_hms_array(grads, cooType) == expected)
+
+    def test_pc2LigthYear_array(self):
+
+        random.seed(2)
+        distances = [0.0, 4.6, 1.15, 12.25] + [round(random.uniform(0, 2000), random.randint(0, 4)) for i in range(5000)]
+        units = [random.choice(["pc", "kpc", "Mpc"]) for d in distances]
+        expected = [multiplanetaryListUpdBot.pc2LigthYear(d, u) for d, u in zip(distances, units)]
+        self.assertTrue(multiplanetaryListUpdBot.pc2LigthYear_array(distances, units).tolist() == expected)
+
     def test_hms_to_numb(self):
         
         n = multiplanetaryListUpdBot.hms_to_numb("7|1|52")
         self.assertTrue(n == 25312,n)
 
-    def test_getCoordFromSimbad(self):
+    def test_getCoordFromSimbadLocalTable(self):
 
-        dist, ra, dec = multiplanetaryListUpdBot.getCoordFromSimbad("24 Sex")
+        cursor = multiplanetaryListUpdBot.sqliteCursor
+        cursor.execute("INSERT INTO simbad (name,ra,dec,mag,dist,ids) VALUES('24 Sex','10|23|28','0|54|8',6.4,239.1,'24 Sex|HD  90043|HIP 50887')")
+        cursor.execute("INSERT INTO simbad (name,ra,dec,mag,dist,ids) VALUES('Kepler-110','19|14|28','43|54|27',14.1,0,'Kepler-110|KOI-124')")
+        multiplanetaryListUpdBot.indexSimbadIds('10|23|28','0|54|8','24 Sex|HD  90043|HIP 50887')
+        multiplanetaryListUpdBot.indexSimbadIds('19|14|28','43|54|27','Kepler-110|KOI-124')
+
+        ra, dec, dist, mag, ids, raDeg, decDeg = multiplanetaryListUpdBot.getCoordFromSimbadLocalTable("hd 90043")
         self.assertTrue(ra == "10|23|28",ra)
-        self.assertTrue(dec == "0|54|8",dec)
         self.assertTrue(dist == 239.1,dist)
 
+        ra, dec, dist, mag, ids, raDeg, decDeg = multiplanetaryListUpdBot.getCoordFromSimbadLocalTable("Kepler-11")  # not a substring match
+        self.assertTrue(ra is None,ra)
+
+        cursor.execute("INSERT INTO simbad (name,ra,dec,mag,dist,ids) VALUES('GJ 876','22|53|16','-14|15|49',10.2,15.2,'GJ 876|IL Aqr')")
+        cursor.execute("INSERT INTO simbad (name,ra,dec,mag,dist,ids) VALUES('GJ 876 B','22|53|17','-14|15|50',0,0,'GJ 876 B')")
+        multiplanetaryListUpdBot.indexSimbadIds('22|53|16','-14|15|49','GJ 876|IL Aqr')
+        multiplanetaryListUpdBot.indexSimbadIds('22|53|17','-14|15|50','GJ 876|GJ 876 B')  # key gj 876 left from previous ids
+        ra, dec, dist, mag, ids, raDeg, decDeg = multiplanetaryListUpdBot.getCoordFromSimbadLocalTable("Gliese 876")
+        self.assertTrue(ra == "22|53|16",ra)
+
+    def test_simbadCache(self):
+
+        multiplanetaryListUpdBot.putSimbadCache("24 Sex", "24 Sex", "10|23|28", "0|54|8", 6.4, 239.1, "24 Sex|HD 90043", 155.87, 0.90, "query_object")
+        multiplanetaryListUpdBot.putSimbadCache("Unknown star", None, None, None, 0, 0, None, None, None, "query_object")
+
+        ra, dec, dist, mag, ids, raDeg, decDeg = multiplanetaryListUpdBot.query_simbad_cached("24 Sex")
+        self.assertTrue(ra == "10|23|28",ra)
+        self.assertTrue(dist == 239.1,dist)
+        ra, dec, dist, mag, ids, raDeg, decDeg = multiplanetaryListUpdBot.query_simbad_cached("Unknown star")
+        self.assertTrue(ra is None,ra)
+
+        multiplanetaryListUpdBot.sqliteCursor.execute("UPDATE simbad_cache SET fetched = 0")  # stale
+        self.assertTrue(multiplanetaryListUpdBot.getSimbadCache("24 Sex", "query_object") is None)
+
+    def test_resolveSimbadOnline(self):
+
+        bot = multiplanetaryListUpdBot
+        calls = []
+        def fakeQuery(name):
+            calls.append(name)
+            if calls.count(name) == 1 and name == "HD 1":  # first attempt fails
+                raise ConnectionError("timeout")
+            if name in ("HD 1", "Kepler-9"):
+                return "0|0|1", "0|0|1", 10.0, 8.0, name, 0.004, 0.0003
+            return bot.simbadNotFound
+
+        original = bot.query_simbad, bot.simbadBackoff
+        bot.query_simbad, bot.simbadBackoff = fakeQuery, 0
+        try:
+            results = list(bot.resolveSimbadOnline(["HD 1", "Kepler-9 B", "Unknown"]))
+        finally:
+            bot.query_simbad, bot.simbadBackoff = original
+
+        self.assertTrue([star for star, answer in results] == ["HD 1", "Kepler-9 B", "Unknown"], results)
+        self.assertTrue(results[1][1][4] == "Kepler-9", results)  # found without the letter of the component
+        self.assertTrue(results[2][1][0] is None, results)
+        self.assertTrue(bot.getSimbadCache("Unknown", "query_object")[0] is None)  # negative result cached
+        self.assertTrue(bot.getSimbadCache("Unknown") is None)  # not an answer of query_objects
+
+    def test_getDataFromSimbadSiteDoubleCheck(self):
+
+        bot = multiplanetaryListUpdBot
+        bot.sqliteCursor.execute("INSERT INTO stars (name,ra,dec,planets) VALUES('HD 1','0|0|0','0|0|0',2),('Kepler-9 B','0|0|0','0|0|0',3),('HD 5','0|0|0','0|0|0',2)")
+        asked = []
+        class FakeSimbad:  # HD 1 found by query_objects, HD 5 only online, Kepler-9 B only online as Kepler-9
+            def query_objects(self, names):
+                found = [name == "HD 1" for name in names]
+                return Table({"main_id": [name if ok else "" for name, ok in zip(names, found)],
+                              "ra": [10.0] * len(names), "dec": [1.0] * len(names),
+                              "mesdistance.dist": [10.0] * len(names), "mesdistance.unit": ["pc"] * len(names),
+                              "V": MaskedColumn([5.0] * len(names)), "ids": [name if ok else "" for name, ok in zip(names, found)],
+                              "user_specified_id": names})
+            def query_object(self, name):
+                asked.append(name)
+                if name == "HD 5":
+                    return Table({"main_id": ["HD 5"], "ra": [30.0], "dec": [2.0], "mesdistance.dist": [20.0],
+                                  "mesdistance.unit": ["pc"], "V": MaskedColumn([7.0]), "ids": ["HD 5"]})
+                if name != "Kepler-9":
+                    return Table()
+                return Table({"main_id": ["Kepler-9"], "ra": [285.0], "dec": [38.4], "mesdistance.dist": [650.0],
+                              "mesdistance.unit": ["pc"], "V": MaskedColumn([13.9]), "ids": ["Kepler-9|KOI-377"]})
+
+        original = bot.configuredSimbad, bot.peculiar_star_names
+        bot.configuredSimbad, bot.peculiar_star_names = FakeSimbad, {}
+        try:
+            bot.getDataFromSimbadSite()
+        finally:
+            bot.configuredSimbad, bot.peculiar_star_names = original
+
+        self.assertTrue(asked == ["Kepler-9 B", "Kepler-9", "HD 5"], asked)  # the double check asked only the stars missing from 'simbad', by their name first
+        bot.sqliteCursor.execute("SELECT name,ra,dec FROM stars ORDER BY name")
+        self.assertTrue(bot.sqliteCursor.fetchall() == [("HD 1", "0|40|0", "1|0|0"), ("HD 5", "2|0|0", "2|0|0"), ("Kepler-9 B", "19|0|0", "38|24|0")])
+
+    def test_getDataFromSimbadSiteMaskedMag(self):
+
+        bot = multiplanetaryListUpdBot
+        asked = []
+        class FakeSimbad:  # Kepler-9 found only online, without V magnitude
+            def query_objects(self, names):
+                return Table({"main_id": [""] * len(names), "ra": [0.0] * len(names), "dec": [0.0] * len(names),
+                              "mesdistance.dist": [0.0] * len(names), "mesdistance.unit": [""] * len(names),
+                              "V": MaskedColumn([0.0] * len(names), mask=[True] * len(names)), "ids": [""] * len(names),
+                              "user_specified_id": names})
+            def query_object(self, name):
+                asked.append(name)
+                return Table({"main_id": ["Kepler-9"], "ra": [285.0], "dec": [38.4], "mesdistance.dist": [650.0],
+                              "mesdistance.unit": ["pc"], "V": MaskedColumn([0.0], mask=[True]), "ids": ["Kepler-9|KOI-377"]})
+
+        original = bot.configuredSimbad, bot.peculiar_star_names
+        bot.configuredSimbad, bot.peculiar_star_names = FakeSimbad, {}
+        try:
+            for run in range(2):  # the second run from 'simbad_cache'
+                bot.createTables()
+                bot.sqliteCursor.execute("INSERT INTO stars (name,ra,dec,planets) VALUES('Kepler-9','0|0|0','0|0|0',3)")
+                bot.getDataFromSimbadSite()
+        finally:
+            bot.configuredSimbad, bot.peculiar_star_names = original
+
+        self.assertTrue(asked == ["Kepler-9"], asked)
+        bot.sqliteCursor.execute("SELECT typeof(mag), mag FROM stars")
+        self.assertTrue(bot.sqliteCursor.fetchall() == [("real", 0.0)])
+
+    def test_getDataFromSimbadSiteBatches(self):
+
+        bot = multiplanetaryListUpdBot
+        for i in range(5):
+            bot.sqliteCursor.execute("INSERT INTO stars (name,ra,dec,planets) VALUES(?,?,?,2)", ("HD " + str(i), "0|0|0", "0|0|0"))
+        asked = []
+        failed = []
+        def fakeQueryObjects(names):
+            asked.append(list(names))
+            if "HD 2" in names and not failed:  # second batch fails on the first run
+                failed.append(names)
+                raise ConnectionError("timeout")
+            n = len(names)
+            return Table({"main_id": names, "ra": [10.0 + int(name[3:]) for name in names], "dec": [1.0] * n,
+                          "mesdistance.dist": [10.0] * n, "mesdistance.unit": ["pc"] * n,
+                          "V": MaskedColumn([5.0] * n), "ids": names, "user_specified_id": names})
+
+        def offlineQuery(name):
+            raise ConnectionError("offline")
+
+        original = bot.query_objects_batch, bot.query_simbad, bot.simbadBatchSize, bot.simbadRetries, bot.peculiar_star_names
+        bot.query_objects_batch, bot.query_simbad = fakeQueryObjects, offlineQuery
+        bot.simbadBatchSize, bot.simbadRetries, bot.peculiar_star_names = 2, 1, {}
+        try:
+            bot.getDataFromSimbadSite()
+            self.assertTrue(bot.getSimbadCache("HD 2") is None)  # failed batch not cached
+            self.assertTrue(bot.getSimbadCache("HD 4")[0] == "HD 4")
+            asked.clear()
+            bot.getDataFromSimbadSite()  # rerun: only the unfinished batch is asked
+        finally:
+            bot.query_objects_batch, bot.query_simbad, bot.simbadBatchSize, bot.simbadRetries, bot.peculiar_star_names = original
+
+        self.assertTrue(asked == [["HD 2", "HD 3"]], asked)
+        bot.sqliteCursor.execute("SELECT COUNT(*) FROM simbad")
+        self.assertTrue(bot.sqliteCursor.fetchone()[0] == 5)
+
+    def test_query_objects_tap(self):
+
+        bot = multiplanetaryListUpdBot
+        answer = io.BytesIO()  # canned answer: GJ 876 twice (two distances), Unknown missing
+        votable.from_table(Table({"name": ["24 Sex", "GJ 876", "GJ 876"], "main_id": ["* 24 Sex", "* GJ 876", "* GJ 876"],
+                                  "ra": [155.86, 343.32, 343.32], "dec": [-0.9, -14.26, -14.26], "V": MaskedColumn([6.45, 10.2, 10.2], dtype=numpy.float32),
+                                  "dist": MaskedColumn([72.1, 4.67, 4.7], mask=[True, False, False]), "unit": ["", "pc", "pc"],
+                                  "ids": ["* 24 Sex|HD 90043", "* GJ 876|IL Aqr", "* GJ 876|IL Aqr"]})).to_xml(answer)
+        requests = []
+        class StandIn(BaseHTTPRequestHandler):  # local stand-in of the TAP service of Simbad
+            def do_POST(self):
+                requests.append(self.rfile.read(int(self.headers["Content-Length"])))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-votable+xml")
+                self.send_header("Content-Length", str(len(answer.getvalue())))
+                self.end_headers()
+                self.wfile.write(answer.getvalue())
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        original = bot.simbadTapUrl
+        try:
+            bot.simbadTapUrl = "http://127.0.0.1:%d/sync" % server.server_address[1]
+            result = bot.query_objects_tap(["GJ 876", "Unknown", "24 Sex"])
+        finally:
+            bot.simbadTapUrl = original
+            server.shutdown()
+
+        self.assertTrue(len(requests) == 1 and b"TAP_UPLOAD.names" in requests[0] and b"Unknown" in requests[0])
+        self.assertTrue(list(result["user_specified_id"]) == ["GJ 876", "Unknown", "24 Sex"] and list(result["main_id"]) == ["* GJ 876", "", "* 24 Sex"])
+        self.assertTrue(result["mesdistance.dist"][0] == 4.67 and result["mesdistance.dist"].mask[2] and result["V"].mask[1])
+        self.assertTrue(result["V"].dtype == float and result["V"][0] == 10.2)  # float32 in the VOTable
+        rows = bot.simbadBatchRows(result)
+        bot.sqliteCursor.execute("SELECT typeof(mag) FROM simbad_cache WHERE name IS NOT NULL")
+        self.assertTrue(bot.sqliteCursor.fetchall() == [("real",), ("real",)])
+        self.assertTrue([row[0] for row in rows] == ["GJ 876", "24 Sex"] and rows[0][4] == 15.2 and rows[1][5].endswith("|HD 90043"), rows)
+        self.assertTrue(bot.getSimbadCache("Unknown")[0] is None)
+
+    def test_exoplanetStars(self):
+
+        lines = [
+            "star_name,name,planet_status,mass,ra,dec,mag_v,star_distance,star_metallicity,star_mass,star_radius,star_sp_type,star_age,star_teff,star_alternate_names",
+            "24 Sex,24 Sex b,Confirmed,1.99,155.86,-0.9,6.45,74.8,-0.03,1.54,4.9,G5 IV,2.7,5098,\"HD 90043, HIP 50887\"",
+            "24 Sex,24 Sex c,Confirmed,0.86,155.86,-0.9,6.45,,-0.03,1.54,4.9,G5 IV,2.7,5098,\"HD 90043, HIP 50887\"",
+            "HD 1,HD 1 b,Confirmed,2.0,1.0,1.0,,,,,,,,,",
+            "HD 1,HD 1 c,Confirmed,20.0,1.0,1.0,,,,,,,,,",  # brown dwarf
+        ]
+        rows = list(multiplanetaryListUpdBot.exoplanetStars(lines))
+        self.assertTrue(len(rows) == 1, rows)
+        self.assertTrue(rows[0].name == "24 Sex" and rows[0].dist == 244.0 and rows[0].planets == 2, rows)
+        self.assertTrue(rows[0].altNames == "HD 90043, HIP 50887" and rows[0].mag == 6.45 and rows[0].ra == "10|23|26", rows)
+        self.assertTrue(isinstance(rows[0].temp, float) and not hasattr(rows[0], "__dict__"))
+
+        with self.assertRaises(ValueError):  # a renamed column is an error, not a shifted field
+            list(multiplanetaryListUpdBot.exoplanetStars([lines[0].replace("star_teff", "teff")] + lines[1:]))
+
+    def test_exoplanetStarsParallel(self):
+
+        bot = multiplanetaryListUpdBot
+        rnd = random.Random(3)
+        catalog = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False, dir=self.temporaryDirectory(), encoding="utf-8", newline='')
+        catalog.write("name,mass,star_name,ra,dec,mag_v,star_distance,star_metallicity,star_mass,star_radius,star_sp_type,star_age,star_teff,star_alternate_names\r\n")
+        for i in range(3000):
+            star = rnd.choice(["HS 0705+6700", "Star %d" % i, "Star %d" % i, "Star %d" % i])
+            for planet in "bcde"[:rnd.randint(1, 4)]:
+                mass = rnd.choice(["1.0", "", "20.0"])  # 20: brown dwarf, ignored without ending the system
+                catalog.write(f"{star} {planet},{mass},{star},{rnd.uniform(0, 360)},{rnd.uniform(-90, 90)},{rnd.choice(['', '7.5'])},"
+                              f"{rnd.choice(['', '12.5'])},0.1,1.0,1.0,\"G2 V, IV\",4.5,5700,\"HD {i}, HIP {i}\"\r\n")
+                if rnd.random() < 0.1:
+                    catalog.write("Sun b,1.0,Sun,0,0,,,,,,,,,\r\n")
+        catalog.close()
+
+        with open(catalog.name, encoding="utf-8", newline='') as linesExo:
+            sequential = list(bot.exoplanetStars(linesExo))
+        original = bot.parseChunkBytes
+        try:
+            bot.parseChunkBytes = 1000
+            header, ranges = bot.exoplanetChunks(catalog.name, 12)
+            self.assertTrue(len(ranges) == 12, ranges)
+            parallel = list(bot.exoplanetStarsParallel(catalog.name, 3))
+        finally:
+            bot.parseChunkBytes = original
+        self.assertTrue(len(sequential) > 100 and parallel == sequential)
+
+    def test_WriteBuffer(self):
+
+        buffer = multiplanetaryListUpdBot.WriteBuffer("INSERT INTO stars (name,planets) VALUES(?,?);", 2)
+        for i in range(5):
+            buffer.add(("HD " + str(i), 2))
+        multiplanetaryListUpdBot.sqliteCursor.execute("SELECT COUNT(*) FROM stars")
+        self.assertTrue(multiplanetaryListUpdBot.sqliteCursor.fetchone()[0] == 4)  # last row still in the buffer
+        buffer.flush()
+        multiplanetaryListUpdBot.sqliteCursor.execute("SELECT COUNT(*) FROM stars")
+        self.assertTrue(multiplanetaryListUpdBot.sqliteCursor.fetchone()[0] == 5)
+
+    def test_nearestCoords(self):
+
+        cursor = multiplanetaryListUpdBot.sqliteCursor
+        cursor.execute("INSERT INTO stars (name,raDeg,decDeg) VALUES('HD 1',359.999,-0.5)")
+        cursor.execute("INSERT INTO stars (name,raDeg,decDeg) VALUES('HD 2',180.0,45.0)")
+        cursor.execute("INSERT INTO stars (name,raDeg,decDeg) VALUES('HD 3',180.002,45.0)")
+
+        rowid, separation = multiplanetaryListUpdBot.nearestCoords("stars", 0.001, -0.5)  # across ra = 0
+        self.assertTrue(rowid == 1 and abs(separation - 7.2) < 0.01, separation)
+        rowid, separation = multiplanetaryListUpdBot.nearestCoords("stars", 180.0015, 45.0)
+        self.assertTrue(rowid == 3, rowid)
+        self.assertTrue(multiplanetaryListUpdBot.nearestCoords("stars", 180.0, 45.1) is None)
+
+        self.assertTrue(multiplanetaryListUpdBot.hms_to_deg("-0|30|0", "DEC") == -0.5)
+
+    def test_fetchSource(self):
+
+        bot = multiplanetaryListUpdBot
+        received = []
+        class StandIn(BaseHTTPRequestHandler):  # local stand-in of a source with ETag support
+            def do_GET(self):
+                received.append(self.headers.get("If-None-Match"))
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = b"name,star_name\n24 Sex b,24 Sex\n"
+                self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        original = bot.sources, bot.snapshotDir, bot.offlineMode
+        try:
+            bot.sources = {"test": {"url": "http://127.0.0.1:%d/catalog" % server.server_address[1]}}
+            bot.snapshotDir = self.temporaryDirectory()
+            path, changed = bot.fetchSource("test")
+            self.assertTrue(changed)
+            path, changed = bot.fetchSource("test")  # unchanged: only a 304 round-trip
+            self.assertTrue(not changed and received == [None, '"v1"'], received)
+            bot.offlineMode = True
+            path, changed = bot.fetchSource("test")  # replay the snapshot without connecting
+            self.assertTrue(len(received) == 2)
+            with open(path, encoding="utf-8") as snapshot:
+                self.assertTrue(snapshot.read() == "name,star_name\n24 Sex b,24 Sex\n")
+        finally:
+            bot.sources, bot.snapshotDir, bot.offlineMode = original
+            server.shutdown()
+
+    def test_cassettes(self):
+
+        bot = multiplanetaryListUpdBot
+        class StandIn:  # the real Simbad while recording
+            def add_votable_fields(self, *fields):
+                pass
+            def query_objects(self, names):
+                return Table({"main_id": names, "V": MaskedColumn([5.0, 0.0], mask=[False, True])})
+            def query_object(self, name):
+                return Table()
+        def download(source):
+            path = os.path.join(bot.snapshotDir, source)
+            with open(path, "w", encoding="utf-8") as snapshot:
+                snapshot.write("name,star_name\n24 Sex b,24 Sex\n")
+            return path, True
+
+        original = bot.SimbadClass, bot.cassetteMode, bot.cassetteDir, bot.sources, bot.snapshotDir, bot.downloadSource
+        try:
+            bot.cassetteDir, bot.snapshotDir = self.temporaryDirectory(), self.temporaryDirectory()
+            bot.sources = {"test": {"url": "http://127.0.0.1:9/catalog", "params": {"format": "csv"}}}
+            bot.SimbadClass, bot.cassetteMode, bot.downloadSource = StandIn, "record", download
+            bot.simbadLocal.__dict__.clear()
+            recorded = bot.configuredSimbad().query_objects(["HD 1", "HD 2"])
+            self.assertTrue(not bot.configuredSimbad().query_object("Unknown"))
+            bot.fetchSource("test")
+
+            bot.SimbadClass, bot.cassetteMode, bot.downloadSource, bot.snapshotDir = None, "replay", None, self.temporaryDirectory()
+            bot.simbadLocal.__dict__.clear()
+            replayed = bot.configuredSimbad().query_objects(["HD 1", "HD 2"])
+            self.assertTrue(list(replayed["main_id"]) == ["HD 1", "HD 2"] and replayed["V"].mask[1] and replayed["V"][0] == recorded["V"][0])
+            self.assertTrue(not bot.configuredSimbad().query_object("Unknown"))
+            with self.assertRaises(LookupError):  # never recorded
+                bot.configuredSimbad().query_object("HD 3")
+            with self.assertRaises(LookupError):  # not retried as a network error
+                bot.callSimbadWithRetry(bot.RateLimiter(0), bot.query_simbad, "HD 3")
+            path, changed = bot.fetchSource("test")
+            self.assertTrue(changed and not bot.fetchSource("test")[1])
+            self.assertTrue(os.path.dirname(path) == os.path.join(bot.cassetteDir, "snapshots") and not os.listdir(bot.snapshotDir))
+            with open(path, encoding="utf-8") as snapshot:
+                self.assertTrue(snapshot.read() == "name,star_name\n24 Sex b,24 Sex\n")
+        finally:
+            bot.SimbadClass, bot.cassetteMode, bot.cassetteDir, bot.sources, bot.snapshotDir, bot.downloadSource = original
+            bot.simbadLocal.__dict__.clear()
+
+    def test_metrics(self):
+
+        bot = multiplanetaryListUpdBot
+        original = {name: getattr(bot, name) for name in bot.instrumentedFunctions}
+        originalFiles = bot.metricsJsonFile, bot.metricsPromFile
+        try:
+            bot.enableMetrics()
+            bot.getSimbadCache("HD 1")
+            bot.putSimbadCache("HD 1", "HD 1", "0|0|0", "0|0|0", 5.0, 10.0, "HD 1", 0.0, 0.0)
+            bot.getSimbadCache("HD 1")
+            bot.getCoordFromSimbadLocalTable("HD 1")
+            self.assertTrue(bot.metrics["simbad_cache.hits"] == 1 and bot.metrics["simbad_cache.misses"] == 1, bot.metrics)
+            self.assertTrue(bot.metrics["getCoordFromSimbadLocalTable.calls"] == 1)
+            self.assertTrue(bot.metrics["sql.INSERT.simbad_cache.rows"] == 1 and bot.metrics["sql.SELECT.simbad_cache.calls"] == 2)
+
+            directory = self.temporaryDirectory()
+            bot.metricsJsonFile, bot.metricsPromFile = directory + "/metrics.json", directory + "/metrics.prom"
+            bot.writeMetrics()
+            with open(bot.metricsPromFile, encoding="utf-8") as promFile:
+                self.assertTrue('multiplanetary_hits{name="simbad_cache"} 1\n' in promFile.read())
+        finally:
+            for name, function in original.items():
+                setattr(bot, name, function)
+            bot.metricsJsonFile, bot.metricsPromFile = originalFiles
+            bot.metricsEnabled = False
+            bot.metrics.clear()
+
+    def test_runPipeline(self):
+
+        bot = multiplanetaryListUpdBot
+        calls = []
+        failing = [True]
+        def fetch(results):
+            calls.append("fetch")
+            return "catalog.csv"
+        def merge(results):
+            calls.append("merge " + results["fetchCatalog"])
+            bot.sqliteCursor.execute("INSERT INTO stars (name) VALUES('HD 1')")
+            bot.sqliteConn.commit()
+            return 1
+        def check(results):
+            calls.append("check")
+            if failing[0]:
+                raise RuntimeError("parsing failed")
+        stages = [("fetchCatalog", [], fetch), ("exoplanet", ["fetchCatalog"], merge), ("check", ["exoplanet"], check)]
+
+        with self.assertRaises(RuntimeError):
+            bot.runPipeline(stages)
+        self.assertTrue(bot.getCheckpoints() == {"fetchCatalog": "catalog.csv", "exoplanet": 1})
+        failing[0] = False
+        bot.runPipeline(stages, resume=True)  # only the failed stage runs again
+        self.assertTrue(calls == ["fetch", "merge catalog.csv", "check", "check"], calls)
+        self.assertTrue(bot.getCheckpoints() == {})
+        bot.runPipeline(stages, resume=True)  # after a completed run, resume starts a new one
+        self.assertTrue(calls[4:] == ["fetch", "merge catalog.csv", "check"], calls)
+        bot.runPipeline(stages)  # a new run starts from scratch
+        bot.sqliteCursor.execute("SELECT COUNT(*) FROM stars")
+        self.assertTrue(bot.sqliteCursor.fetchone()[0] == 1 and calls.count("fetch") == 3)
+
+    def test_getDataFromNASA(self):
+
+        bot = multiplanetaryListUpdBot
+        cursor = bot.sqliteCursor
+        cursor.execute("INSERT INTO stars (name,mag,dist,type,altNames,raDeg,decDeg) VALUES('HD 1',0,0,'','',10.0,20.0)")
+        cursor.execute("INSERT INTO stars (name,mag,dist,type,altNames,raDeg,decDeg) VALUES('Kepler-1',7.5,0,'','KOI-1, TrES-2',100.0,-5.0)")
+        cursor.execute("INSERT INTO stars (name,mag,dist,type,altNames,raDeg,decDeg) VALUES('WASP-1',0,0,'K0',NULL,200.0,60.0)")
+        nasaFile = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False, dir=self.temporaryDirectory(), encoding="utf-8")
+        nasaFile.write("hostname,ra,dec,sy_vmag,sy_dist,st_spectype,st_mass,st_rad,st_teff,st_age,st_met\n"
+                       "hd  1,10.0,20.0,,,,1.1,,,,\n"                   # by normalized name
+                       "HD 1,10.0,20.0,6.5,10,\"G2 V, IV\",1.2,,,,\n"  # first not empty value of every field
+                       "TrES-2,100.0,-5.0,8.0,100,,,,,,\n"              # by alternate name
+                       "NASA 3,200.001,60.0,9.5,,,,,,,\n"                # by coordinates
+                       "NASA 4,300.0,0.0,9.5,,,,,,,\n")                  # not in 'stars'
+        nasaFile.close()
+
+        bot.getDataFromNASA(nasaFile.name)
+        cursor.execute("SELECT name,mag,dist,type,mass FROM stars ORDER BY rowid")
+        rows = cursor.fetchall()
+        self.assertTrue(rows[0] == ("HD 1", 6.5, 32.6, "G2 V, IV", 1.1), rows[0])
+        self.assertTrue(rows[1] == ("Kepler-1", 7.5, 326.2, "", 0.0), rows[1])
+        self.assertTrue(rows[2] == ("WASP-1", 9.5, 0.0, "K0", 0.0), rows[2])
+
+    def test_watch(self):
+
+        bot = multiplanetaryListUpdBot
+        directory = self.temporaryDirectory()
+        files = {"exoplanet": "star_name,name,planet_status,mass,ra,dec,mag_v,star_distance,star_metallicity,star_mass,star_radius,star_sp_type,star_age,star_teff,star_alternate_names\n"
+                              "HD 1,HD 1 b,Confirmed,1.0,10.0,20.0,6.5,10,,,,G2 V,,,\nHD 1,HD 1 c,Confirmed,1.0,10.0,20.0,6.5,10,,,,G2 V,,,\n"
+                              "HD 2,HD 2 b,Confirmed,1.0,30.0,40.0,,20,,,,K0,,,\nHD 2,HD 2 c,Confirmed,1.0,30.0,40.0,,20,,,,K0,,,\n",
+                 "nasa": "hostname,ra,dec,sy_vmag,sy_dist,st_spectype,st_mass,st_rad,st_teff,st_age,st_met\nHD 2,30.0,40.0,8.5,,,,,,,\n",
+                 "wikipedia": "{{Stelle con pianeti extrasolari confermati|Stella=[[HD 1]]||Ascensione retta={{RA|0|40|0}}||Declinazione={{DEC|20|0|0}}||Massa=1,5||Pianeti=2}}\n",
+                 "wikipedia2": "{{Stelle con pianeti extrasolari confermati|Stella=[[HD 1]]||Ascensione retta={{RA|0|40|0}}||Declinazione={{DEC|20|0|0}}||Massa=2,5||Pianeti=2}}\n"}
+        for name, text in files.items():
+            with open(os.path.join(directory, name), "w", encoding="utf-8") as sourceFile:
+                sourceFile.write(text)
+        polls = {"exoplanet": [True, False, False, False], "nasa": [True, False, True, False], "wikipedia": [True, False, False, True]}
+        broken = []
+        def fetch(source):  # cycle 2: nothing changed; 3: NASA sent the same data; 4: Wikipedia changed
+            changed = polls[source].pop(0)
+            if source in broken:
+                broken.remove(source)
+                return os.path.join(directory, "missing"), changed
+            return os.path.join(directory, "wikipedia2" if source == "wikipedia" and not polls[source] else source), changed
+        def queryObjects(names):
+            coords = {"HD 1": (10.0, 20.0), "HD 2": (30.0, 40.0)}
+            return Table({"main_id": names, "ra": [coords[name][0] for name in names], "dec": [coords[name][1] for name in names],
+                          "mesdistance.dist": [10.0] * len(names), "mesdistance.unit": ["pc"] * len(names),
+                          "V": MaskedColumn([0.0] * len(names), mask=[True] * len(names)), "ids": names, "user_specified_id": names})
+        calls = []
+        def counted(name, function):
+            return lambda *args: (calls.append(name), function(*args))[1]
+
+        original = (bot.fetchSource, bot.query_objects_batch, bot.peculiar_star_names, bot.watchIntervals, bot.tableOutFile,
+                    bot.getDataFromExoplanet, bot.getDataFromNASA, bot.generateWikitable)
+        bot.fetchSource, bot.query_objects_batch, bot.peculiar_star_names = fetch, queryObjects, {}
+        bot.watchIntervals, bot.tableOutFile = {"exoplanet": 0, "nasa": 0, "wikipedia": 0}, os.path.join(directory, "tabella.wiki")
+        bot.getDataFromExoplanet = counted("exoplanet", bot.getDataFromExoplanet)
+        bot.getDataFromNASA = counted("nasa", bot.getDataFromNASA)
+        bot.generateWikitable = counted("render", bot.generateWikitable)
+        try:
+            bot.watch(cycles=4)
+            bot.sqliteCursor.execute("SELECT count(*) FROM runs")
+            runs = bot.sqliteCursor.fetchone()[0]
+            polls.update({"exoplanet": [True], "nasa": [True], "wikipedia": [True]})
+            bot.watch(cycles=1)  # restarted: same 'stars', no new run nor table
+            bot.sqliteCursor.execute("SELECT count(*) FROM runs")
+            self.assertTrue(bot.sqliteCursor.fetchone()[0] == runs)
+            polls.update({"exoplanet": [False, False], "nasa": [True, False], "wikipedia": [False, True]})
+            broken.append("nasa")
+            bot.watch(cycles=2)  # NASA file missing: exits, kept alive and tried again at the next poll
+        finally:
+            (bot.fetchSource, bot.query_objects_batch, bot.peculiar_star_names, bot.watchIntervals, bot.tableOutFile,
+             bot.getDataFromExoplanet, bot.getDataFromNASA, bot.generateWikitable) = original
+
+        # NASA unchanged in the result: no render; Wikipedia changed: NASA not run again
+        self.assertTrue(calls == ["exoplanet", "nasa", "render", "nasa", "render", "exoplanet", "nasa", "nasa", "nasa"], calls)
+        bot.sqliteCursor.execute("SELECT name,mag,mass FROM stars ORDER BY name")
+        self.assertTrue(bot.sqliteCursor.fetchall() == [("HD 1", 6.5, 2.5), ("HD 2", 8.5, 0.0)])
+        with open(os.path.join(directory, "tabella.wiki"), encoding="utf-8") as table:
+            self.assertTrue("Massa=2,5" in table.read())
+
+    def test_NameResolver(self):
+
+        bot = multiplanetaryListUpdBot
+        cursor = bot.sqliteCursor
+        cursor.execute("INSERT INTO stars (name,ra,dec,altNames) VALUES('GJ 876','22|53|16','-14|15|49','IL Aqr')")
+        cursor.execute("INSERT INTO stars (name,ra,dec,altNames) VALUES('Kepler-47 (AB)','19|41|11','46|55|13','')")
+        cursor.execute("INSERT INTO stars (name,ra,dec,altNames) VALUES('HD 41004 A','5|59|49','-48|14|22','HD 41004')")
+        cursor.execute("INSERT INTO stars (name,ra,dec,altNames) VALUES('HD 41004 B','5|59|49','-48|14|22','HD 41004')")
+        cursor.execute("INSERT INTO stars (name,ra,dec,altNames) VALUES('Mu Arae','17|44|8','-51|50|3',NULL)")
+        bot.indexSimbadIds('22|53|16', '-14|15|49', "NAME Gliese 876|HIP 113020|*  IL Aqr")
+
+        resolver = bot.nameResolver()
+        self.assertTrue(resolver.resolve("Gliese 876") == 1 and resolver.resolve("hip  113020") == 1 and resolver.resolve("IL Aqr") == 1)
+        self.assertTrue(resolver.resolve("Kepler-47") == 2)  # without (AB)
+        self.assertTrue(resolver.resolve("HD 41004 B") == 4 and resolver.resolve("HD 41004") is None)  # ambiguous
+        self.assertTrue(resolver.resolve("mu Ara") == 5)  # peculiar_star_names
+        self.assertTrue(resolver.startsWith("HD 4100") == 3 and resolver.startsWith("Kepler-47") == 2 and resolver.startsWith("Kepler-48") is None)
+        self.assertTrue(resolver.startsWith("HD 41004 b") == 4 and resolver.startsWith("m") == 5 and resolver.startsWith("") is None)
+        self.assertTrue(bot.nameResolver() is resolver)
+        bot.createTables()
+        self.assertTrue(bot.nameResolver() is not resolver)
+
+    def test_wikiRows(self):
+
+        bot = multiplanetaryListUpdBot
+        page = io.StringIO("<noinclude>{{Stelle con pianeti extrasolari confermati/Top}}</noinclude>\n"
+            "{{Stelle con pianeti extrasolari confermati\n"
+            "|Stella=[[HD 1|HD 1 (star)]]<ref>{{cita web|url=x|titolo=a||b}}</ref>||Ascensione retta={{RA|10|23|28,50}}||Declinazione={{DEC|−00|30|00}}"
+            "||Magnitudine apparente=6,45||Distanza=244||Tipo spettrale=G5 IV||Massa=-||Raggio=||Temperatura=5098||Età=2,7||Metallicità=−0,03||Pianeti=2}}\n"
+            "{{Stelle con pianeti extrasolari confermati|Stella=[[GJ 876]]||Ascensione retta={{RA|22|53|16}}||Declinazione={{DEC|-14|15|49}}||Distanza=~15||Pianeti=4}}\n"
+            "<noinclude>{{Stelle con pianeti extrasolari confermati/Bottom}}</noinclude>\n")
+
+        rows = list(bot.wikiRows(page))
+        self.assertTrue(len(rows) == 2, rows)
+        self.assertTrue(rows[0]["name"] == "HD 1" and rows[0]["ref"] and rows[0]["Stella"].startswith("HD 1|HD 1 (star)<ref>"), rows[0])
+        self.assertTrue(abs(rows[0]["Ascensione retta"] - 155.86875) < 1e-9 and rows[0]["Declinazione"] == -0.5)
+        self.assertTrue(rows[0]["Magnitudine apparente"] == 6.45 and rows[0]["Metallicità"] == -0.03 and rows[0]["Massa"] is None and rows[0]["Raggio"] is None)
+        self.assertTrue(rows[1]["name"] == "GJ 876" and not rows[1]["ref"] and rows[1]["Distanza"] == "~15" and rows[1]["Pianeti"] == 4)
+
+    def test_commandLine(self):
+
+        bot = multiplanetaryListUpdBot
+        directory = self.temporaryDirectory()
+        check = subprocess.run([sys.executable, "-c", "import sys, multiplanetaryListUpdBot; print('astroquery' in sys.modules, 'requests' in sys.modules)"],
+                               cwd=directory, env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(bot.__file__))), capture_output=True, text=True)
+        self.assertTrue(check.stdout.strip() == "False False" and os.listdir(directory) == [], (check.stdout, check.stderr))
+
+        stages = bot.selectStages(bot.pipelineStages, bot.commandStages["render"])
+        self.assertTrue([(stage, needs) for stage, needs, _ in stages] == [("render", [])])
+        stages = bot.selectStages(bot.pipelineStages, bot.commandStages["resolve"])
+        self.assertTrue([(stage, needs) for stage, needs, _ in stages] == [("fetchExoplanet", []), ("exoplanet", ["fetchExoplanet"]), ("simbad", ["exoplanet"])])
+
+    def test_renderTables(self):
+
+        bot = multiplanetaryListUpdBot
+        cursor = bot.sqliteCursor
+        cursor.execute("INSERT INTO stars (name,ra,dec,mag,dist,type,mass,radius,temp,age,metall,planets) VALUES('HD 1 <ref>http://a.org</ref>','1|2|3','-5|6|7',6.456,100.5,'K1.5 V',0,1.2,5000,2.5,-0.1,3)")
+        cursor.execute("INSERT INTO stars (name,ra,dec,mag,dist,type,mass,radius,temp,age,metall,planets) VALUES('GJ 876','22|53|16','-14|15|49',10.2,15.2,'M4 V',0.37,0.36,3200,0,0.2,4)")
+        directory = self.temporaryDirectory()
+        executed = []
+        bot.sqliteConn.set_trace_callback(executed.append)
+        bot.generateWikitable(directory + "/it.wiki", [("wikitable-en", directory + "/en.wiki"), ("json", directory + "/stars.json")])
+        bot.sqliteConn.set_trace_callback(None)
+        self.assertTrue(len(executed) == 1, executed)  # one pass for all the outputs
+
+        with open(directory + "/it.wiki", encoding="utf-8") as itWiki:
+            lines = itWiki.read().split("\n")
+        self.assertTrue(lines[0] == "{{Progetto sistemi multiplanetari|con2pianeti=0|con3pianeti=1|con4pianeti=1|con5pianeti=0|con6pianeti=0|con7pianeti=0|con8pianeti=0}}", lines[0])
+        self.assertTrue(lines[6] == "|Stella=[[HD 1 ]]<ref>http://a.org</ref>||Ascensione retta={{RA|01|02|03}}||Declinazione={{DEC|-05|06|07}}||Magnitudine apparente=6,46"
+                        "||Distanza=100,5||Tipo spettrale=K1,5 V||Massa=||Raggio=1,2||Temperatura=5000||Età=2,5||Metallicità=-0,1||Pianeti=3}}", lines[6])
+        with open(directory + "/en.wiki", encoding="utf-8") as enWiki:
+            self.assertTrue("|-\n| [[GJ 876]] || {{RA|22|53|16}} || {{DEC|-14|15|49}} || 10.2 || 15.2 || M4 V || 0.37 || 0.36 || 3200 ||  || 0.2 || 4\n" in enWiki.read())
+        with open(directory + "/stars.json", encoding="utf-8") as starsJson:
+            self.assertTrue([star["name"] for star in json.load(starsJson)] == ["GJ 876", "HD 1 <ref>http://a.org</ref>"])
+
+    def test_exportColumnar(self):
+
+        bot = multiplanetaryListUpdBot
+        cursor = bot.sqliteCursor
+        cursor.execute("INSERT INTO stars (name,ra,dec,raDeg,decDeg,mag,dist,type,planets) VALUES('GJ 876','22|53|16','-14|15|49',343.3,-14.26,10.2,15.2,'M4 V',4)")
+        cursor.execute("INSERT INTO stars (name,ra,dec,raDeg,decDeg,mag,dist,type,planets) VALUES('Età Ceti','1|2|3','4|5|6',15.5,4.1,'',NULL,NULL,2)")
+        cursor.execute("INSERT INTO simbad (name,ra,dec,mag,dist,ids,raDeg,decDeg) VALUES('GJ 876','22|53|16','-14|15|49',10.2,15.2,'GJ 876|IL Aqr',343.3,-14.26)")
+        directory = self.temporaryDirectory() + "/catalog"
+        bot.exportColumnar(directory)
+        bot.exportColumnar(directory)  # replaces the previous snapshot
+
+        catalog = bot.loadColumnar(directory)
+        stars = catalog["stars"]
+        self.assertTrue(list(stars["name"]) == ["Età Ceti", "GJ 876"] and stars["type"][0] == "" and stars["type"][-1] == "M4 V")
+        self.assertTrue(stars["dist"][1] == 15.2 and math.isnan(stars["mag"][0]) and math.isnan(stars["dist"][0]))
+        self.assertTrue(isinstance(stars["raDeg"], numpy.memmap) and stars["raDeg"].dtype == numpy.float64 and list(stars["planets"]) == [2.0, 4.0])
+        self.assertTrue(list(catalog["simbad"]["ids"]) == ["GJ 876|IL Aqr"])
+
+    def test_diffRuns(self):
+
+        bot = multiplanetaryListUpdBot
+        cursor = bot.sqliteCursor
+        cursor.execute("INSERT INTO stars (name,mag,dist,planets) VALUES('GJ 876',10.2,15.2,4),('Gliese 581',10.6,6.3,3),('HD 10180',7.3,39.0,6)")
+        first = bot.recordRun()
+        cursor.execute("DELETE FROM stars WHERE name='HD 10180'")
+        cursor.execute("UPDATE stars SET dist=15.3, planets=5 WHERE name='GJ 876'")
+        cursor.execute("UPDATE stars SET planets=2 WHERE name='Gliese 581'")
+        cursor.execute("INSERT INTO stars (name,mag,dist,planets) VALUES('TOI-700',13.1,31.1,4)")
+        second = bot.recordRun()
+
+        diff = bot.diffRuns()
+        self.assertTrue((diff["old"], diff["new"]) == (first, second))
+        self.assertTrue(diff["added"] == [("TOI-700", 4)] and diff["removed"] == [("HD 10180", 6)])
+        self.assertTrue(diff["changed"] == [("GJ 876", {"dist": (15.2, 15.3)})], diff["changed"])
+        self.assertTrue(diff["planets"] == [("Gliese 581", 3, 2), ("GJ 876", 4, 5)], diff["planets"])
+        self.assertTrue(bot.diffRuns(second, second)["changed"] == [] and "1 added, 1 removed" in bot.formatDiff(diff))
+
+    def test_publishDB(self):
+
+        bot = multiplanetaryListUpdBot
+        path = os.path.join(self.temporaryDirectory(), "stars.db")
+        bot.connectDB(path)
+        bot.sqliteCursor.execute("PRAGMA journal_mode=WAL")  # as built by the previous versions
+        bot.createTables()
+        bot.putSimbadCache("HD 1", "HD 1", "0|0|1", "0|0|1", 8.0, 10.0, "HD 1", 0.004, 0.0003)
+        bot.sqliteCursor.execute("INSERT INTO stars (name,planets) VALUES('HD 1',2)")
+        bot.sqliteConn.commit()
+        bot.sqliteConn.close()
+
+        original = bot.publishPath
+        reader = None
+        try:
+            for name in ("HD 2", "HD 3"):
+                bot.openBuildDB(path)  # only the tables kept between runs
+                self.assertTrue(bot.getSimbadCache("HD 1")[0] == "HD 1")
+                bot.createTables()
+                bot.sqliteCursor.execute("INSERT INTO stars (name,planets) VALUES(?,3)", (name,))
+                bot.sqliteConn.commit()
+                bot.publishDB(bot.publishPath)
+                bot.sqliteConn.close()
+                if reader is None:
+                    reader = sl.connect(path)  # opened before the second publish: keeps seeing the first build
+                    reader.execute("BEGIN")
+                self.assertTrue(reader.execute("SELECT name FROM stars").fetchall() == [("HD 2",)])
+            self.assertTrue(sorted(os.listdir(os.path.dirname(path))) == ["stars.db"])
+
+            bot.openBuildDB(path, seed=True)
+            bot.sqliteCursor.execute("SELECT name FROM stars")
+            self.assertTrue(bot.sqliteCursor.fetchall() == [("HD 3",)] and bot.getSimbadCache("HD 1")[0] == "HD 1")
+
+            bot.createTables()  # a failed run
+            bot.putCheckpoint("exoplanet", None)
+            bot.sqliteCursor.execute("INSERT INTO stars (name,planets) VALUES('HD 4',2)")
+            bot.sqliteConn.commit()
+            bot.sqliteCursor.execute("INSERT INTO stars (name,planets) VALUES('HD 5',2)")  # by the failed stage
+            bot.saveResumeDB(bot.publishPath)
+            bot.sqliteConn.close()
+            bot.openBuildDB(path, seed=True, resume=True)
+            bot.sqliteCursor.execute("SELECT name FROM stars")
+            self.assertTrue(bot.sqliteCursor.fetchall() == [("HD 4",)] and list(bot.getCheckpoints()) == ["exoplanet"])
+            bot.publishDB(bot.publishPath)
+            bot.sqliteConn.close()
+            self.assertTrue(sorted(os.listdir(os.path.dirname(path))) == ["stars.db"])  # resumed: .resume removed
+            bot.openBuildDB(path, seed=True, resume=True)  # without a failed run: from path
+            bot.sqliteCursor.execute("SELECT name FROM stars")
+            self.assertTrue(bot.sqliteCursor.fetchall() == [("HD 4",)])
+        finally:
+            bot.publishPath = original
+            if reader is not None:
+                reader.close()
+
+    def test_getCoordFromSimbad(self):
+
+        bot = multiplanetaryListUpdBot
+        class Recorded:  # the answer of Simbad to 24 Sex, recorded in the cassette
+            def add_votable_fields(self, *fields):
+                pass
+            def query_object(self, name):
+                return Table({"main_id": ["* 24 Sex"], "ra": [155.86822], "dec": [-0.90225], "mesdistance.dist": [73.31], "mesdistance.unit": ["pc"],
+                              "V": [6.44], "ids": ["HD  90043|HIP  50887|*  24 Sex"]}) if name == "24 Sex" else Table()
+
+        original = bot.SimbadClass, bot.cassetteMode, bot.cassetteDir
+        try:
+            bot.cassetteDir = self.temporaryDirectory()
+            bot.SimbadClass, bot.cassetteMode = Recorded, "record"
+            bot.simbadLocal.__dict__.clear()
+            bot.getCoordFromSimbadOnline("24 Sex")
+
+            bot.SimbadClass, bot.cassetteMode = None, "replay"  # offline
+            bot.simbadLocal.__dict__.clear()
+            bot.sqliteCursor.execute("DELETE FROM simbad_cache")
+            ra, dec, dist, mag, ids, raDeg, decDeg = bot.getCoordFromSimbadOnline("24 Sex")
+            bot.sqliteCursor.execute("SELECT count(*) FROM simbad_cache")
+            self.assertTrue(bot.sqliteCursor.fetchone()[0] == 0)  # replayed answers not cached for the real runs
+            self.assertTrue(ra == "10|23|28",ra)
+            self.assertTrue(dec == "0|54|8",dec)
+            self.assertTrue(dist == 239.1,dist)
+            self.assertTrue(ids == "HD  90043|HIP  50887|24 Sex",ids)
+        finally:
+            bot.SimbadClass, bot.cassetteMode, bot.cassetteDir = original
+            bot.simbadLocal.__dict__.clear()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file